@@ -1,13 +1,34 @@
 import dash
 from dash import Dash, html, dcc
 import dash_bootstrap_components as dbc
+import flask
+import json
+import database_import as dbi
+import warmup
 
-app = Dash(__name__, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP])
+# The page layouts are functions that load their data on first use. Suppressing callback exceptions
+# keeps Dash from calling all of them to build a validation layout on the first request.
+app = Dash(__name__, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
 
 server = app.server
 app.layout = html.Div([
     dash.page_container,
 ])
 
+@server.route('/healthz')
+def healthz():
+    # Only report healthy once the data is loaded, so that no traffic is sent to a cold instance
+    if warmup.ready.is_set():
+        return 'OK', 200
+    return 'Warming up', 503
+
+@server.route('/metrics')
+def metrics():
+    # Cache and query metrics of the worker process answering the request, see dbi.get_metrics
+    # Not jsonify, which sorts the keys and would shuffle the buckets of the latency histograms
+    return flask.Response(json.dumps(dbi.get_metrics()), mimetype='application/json')
+
+warmup.start()
+
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -1,5 +1,217 @@
+import json
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import sqlalchemy
+
+# The queries get_preprocessed_data reads its data with, see fetch_source_tables()
+SOURCE_QUERIES = {
+    # All donors with at least one donation
+    "donors": """
+            SELECT 
+                d.ID as 'Donor_ID', 
+                d.date_registered, 
+                d.name_ID, 
+                d.has_password,
+                d.is_person,
+                d.is_anon,
+                d.Meta_owner_ID,
+                d.newsletter
+            FROM v_Donors_anon d
+            WHERE EXISTS (SELECT 1 FROM Donations ds WHERE ds.Donor_ID = d.ID)
+            """,
+    # The donations, tax units and ssns of these donors. The filters are semi-joins in the query, so that
+    # the rows of test donors and of donors without donations are never transferred.
+    "donations": """
+        SELECT 
+            ds.* 
+        FROM Donations ds
+        WHERE ds.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+        """,
+    "tax_units": """
+        SELECT 
+            tu.* 
+        FROM v_Tax_unit_anon tu
+        WHERE tu.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+            AND EXISTS (SELECT 1 FROM Donations ds WHERE ds.Donor_ID = tu.Donor_ID)
+    """,
+    "tax_unit_ssn": """
+        SELECT
+            tu.ID,
+            tu.Donor_ID,
+            tu.ssn
+        FROM Tax_unit tu
+        WHERE tu.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+            AND EXISTS (SELECT 1 FROM Donations ds WHERE ds.Donor_ID = tu.Donor_ID)
+    """,
+    "combining_table": """
+        SELECT
+            c.ID,
+            c.KID as 'KID_fordeling',
+            c.Tax_unit_ID
+        FROM
+            Combining_table c
+    """,
+    "donor_names": "SELECT d.ID, d.full_name FROM Donors d where d.full_name is not NULL and not d.full_name=''",
+}
+ANON_SOURCES = ["donors", "donations", "tax_units", "tax_unit_ssn", "combining_table"]
+
+# The queries update_preprocessing_state() reads the rows added since the last update with. {donations},
+# {tax_units} and {combining_table} are the highest IDs already read, and {max_donations}, {max_tax_units}
+# and {max_combining_table} the highest IDs when the update started, so that all queries see the same rows.
+# Tax units are new as well if they belong to donors whose first donation is new.
+MAX_ID_QUERY = """
+    SELECT
+        (SELECT COALESCE(MAX(ID), 0) FROM Donations) as 'donations',
+        (SELECT COALESCE(MAX(ID), 0) FROM Tax_unit) as 'tax_units',
+        (SELECT COALESCE(MAX(ID), 0) FROM Combining_table) as 'combining_table'
+"""
+INCREMENTAL_QUERIES = {
+    "donors": """
+            SELECT 
+                d.ID as 'Donor_ID', 
+                d.date_registered, 
+                d.name_ID, 
+                d.has_password,
+                d.is_person,
+                d.is_anon,
+                d.Meta_owner_ID,
+                d.newsletter
+            FROM v_Donors_anon d
+            WHERE d.ID IN (
+                SELECT ds.Donor_ID FROM Donations ds WHERE ds.ID > {donations} AND ds.ID <= {max_donations}
+            )
+            """,
+    "donations": """
+        SELECT 
+            ds.* 
+        FROM Donations ds
+        WHERE ds.ID > {donations} AND ds.ID <= {max_donations}
+            AND ds.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+        """,
+    "tax_units": """
+        SELECT 
+            tu.* 
+        FROM v_Tax_unit_anon tu
+        WHERE tu.ID <= {max_tax_units}
+            AND (
+                tu.ID > {tax_units}
+                OR tu.Donor_ID IN (
+                    SELECT ds.Donor_ID FROM Donations ds WHERE ds.ID > {donations} AND ds.ID <= {max_donations}
+                )
+            )
+            AND tu.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+            AND EXISTS (SELECT 1 FROM Donations ds WHERE ds.Donor_ID = tu.Donor_ID AND ds.ID <= {max_donations})
+    """,
+    "tax_unit_ssn": """
+        SELECT
+            tu.ID,
+            tu.Donor_ID,
+            tu.ssn
+        FROM Tax_unit tu
+        WHERE tu.ID <= {max_tax_units}
+            AND (
+                tu.ID > {tax_units}
+                OR tu.Donor_ID IN (
+                    SELECT ds.Donor_ID FROM Donations ds WHERE ds.ID > {donations} AND ds.ID <= {max_donations}
+                )
+            )
+            AND tu.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+            AND EXISTS (SELECT 1 FROM Donations ds WHERE ds.Donor_ID = tu.Donor_ID AND ds.ID <= {max_donations})
+    """,
+    "combining_table": """
+        SELECT
+            c.ID,
+            c.KID as 'KID_fordeling',
+            c.Tax_unit_ID
+        FROM
+            Combining_table c
+        WHERE c.ID > {combining_table} AND c.ID <= {max_combining_table}
+    """,
+    # The number of rows the state should have after the update, see update_preprocessing_state()
+    "row_counts": """
+        SELECT
+            (
+                SELECT COUNT(*) FROM Donations ds
+                WHERE ds.ID <= {max_donations} AND ds.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+            ) as 'donations',
+            (
+                SELECT COUNT(*) FROM v_Tax_unit_anon tu
+                WHERE tu.ID <= {max_tax_units}
+                    AND tu.Donor_ID IN (SELECT d.ID FROM v_Donors_anon d)
+                    AND EXISTS (
+                        SELECT 1 FROM Donations ds WHERE ds.Donor_ID = tu.Donor_ID AND ds.ID <= {max_donations}
+                    )
+            ) as 'tax_units'
+    """,
+}
+
+# The state of incremental preprocessing is rebuilt from scratch at least this often, which picks up changes
+# to rows that were already read. Between rebuilds only new rows are read, see update_preprocessing_state().
+FULL_REBUILD_INTERVAL = timedelta(hours=12)
+# The name_ID all anonymous donors get in the state. name_ID is only the key donors are merged on, so any
+# value that no donor has will do, and unlike max + 1 it does not collide with the names of new donors.
+ANON_NAME_ID = -1
+# The frames of the state, see build_preprocessing_state()
+STATE_FRAMES = [
+    "donors",
+    "donations",
+    "tax_units",
+    "tax_unit_ssn",
+    "combining_table",
+    "donor_groups",
+    "tax_units_corr",
+    "donor_map",
+]
+
+# Columns stored with smaller dtypes in the compact mode of get_preprocessed_data, see compact_dtypes()
+COMPACT_INT32_COLUMNS = [
+    "ID",
+    "Donor_ID",
+    "Meta_owner_ID",
+    "new_donor_id",
+    "old_donor_id",
+]
+COMPACT_CATEGORY_COLUMNS = ["Payment_ID", "KID_fordeling", "gender"]
+COMPACT_CHUNK_ROWS = 100000  # Rows read at a time in the compact mode
+
+# OrgId of direct donations to GiveWell, see split_donations_by_org()
+GE_ORG_ID = 11
+
+# The distribution percentages of the last data version they were read for, see get_distribution_percentages()
+distribution_percentages = None
+distribution_percentages_version = None
+distribution_percentages_lock = Lock()
+
+# Common girl and boy names, which add_gender() guesses genders from
+GENDERED_NAMES_FILE = "../GenderedNames.csv"
+
+# The genders guessed from the first names, kept between calls of add_gender() so that only new and
+# renamed donors are classified again: columns full_name and female_name, indexed by donor ID.
+# Only valid for the names file they were guessed with, which is identified by its path and mtime.
+name_genders = None
+name_genders_file = None
+name_genders_lock = Lock()
+
+# Sources that can be read from the cache of database_import instead, as (table, columns, renamed columns).
+# Only anonymized tables, as the cache may be stored in snapshots on disk. These are read in full, and
+# filtered on the donors by get_preprocessed_data_anon().
+CACHED_SOURCES = {
+    "donations": ("Donations", None, {}),
+    "tax_units": ("v_Tax_unit_anon", None, {}),
+    "combining_table": (
+        "Combining_table",
+        ["ID", "KID", "Tax_unit_ID"],
+        {"KID": "KID_fordeling"},
+    ),
+}
 
 
 def check_for_duplicates(d_corr, ds_corr, tu_corr):
@@ -22,7 +234,166 @@ def check_for_duplicates(d_corr, ds_corr, tu_corr):
         )
 
 
-def get_preprocessed_data_anon(db_conn):
+def compact_dtypes(df):
+    """
+    Stores the ID columns of df (COMPACT_INT32_COLUMNS) as int32 if all their values fit, and the columns with
+    few distinct values (COMPACT_CATEGORY_COLUMNS) as categoricals. Only the dtypes change, not the values.
+    -----------------------------------------------------------------------
+    Parameters:
+        df: pd.DataFrame
+
+    ------------------------------------------------------------------------
+    Returns:
+        df: pd.DataFrame
+            df with compact dtypes, or df itself if there is nothing to change
+    """
+    int32 = np.iinfo(np.int32)
+    dtypes = {}
+    for column in df.columns:
+        values = df[column]
+        if (
+            column in COMPACT_INT32_COLUMNS
+            and pd.api.types.is_integer_dtype(values)
+            and values.dtype != "int32"
+            and (values.empty or int32.min <= values.min() <= values.max() <= int32.max)
+        ):
+            dtypes[column] = "int32"
+        elif (
+            column in COMPACT_CATEGORY_COLUMNS
+            and not pd.api.types.is_categorical_dtype(values)
+        ):
+            dtypes[column] = "category"
+    return df.astype(dtypes) if dtypes else df
+
+
+def expand_dtypes(df):
+    """
+    Undoes compact_dtypes(): the int32 ID columns become int64 again, and the categoricals get the dtype of
+    their categories, so that the results of the compact mode are identical to those without it
+    -----------------------------------------------------------------------
+    Parameters:
+        df: pd.DataFrame
+
+    ------------------------------------------------------------------------
+    Returns:
+        df: pd.DataFrame
+            df with the dtypes pd.read_sql gives, or df itself if there is nothing to change
+    """
+    dtypes = {}
+    for column in df.columns:
+        values = df[column]
+        if column in COMPACT_INT32_COLUMNS and values.dtype == "int32":
+            dtypes[column] = "int64"
+        elif column in COMPACT_CATEGORY_COLUMNS and pd.api.types.is_categorical_dtype(
+            values
+        ):
+            dtypes[column] = values.cat.categories.dtype
+    return df.astype(dtypes) if dtypes else df
+
+
+def read_sql_compact(query, db_conn):
+    """
+    Reads the result of query like pd.read_sql, but COMPACT_CHUNK_ROWS rows at a time with compact_dtypes(),
+    so that only one chunk of rows is held as Python objects at a time rather than the whole result.
+    -----------------------------------------------------------------------
+    Parameters:
+        query: string
+
+        db_conn: SQLAlchemy engine or db-connection
+
+    ------------------------------------------------------------------------
+    Returns:
+        df: pd.DataFrame
+            the result of query, with compact dtypes
+    """
+    chunks = [
+        compact_dtypes(chunk)
+        for chunk in pd.read_sql(query, db_conn, chunksize=COMPACT_CHUNK_ROWS)
+    ]
+    if not chunks:
+        return compact_dtypes(pd.read_sql(query, db_conn))
+    return compact_dtypes(concat_rows(chunks))
+
+
+def concat_rows(frames):
+    """
+    Concatenates the rows of frames read by parts of the same query, with the dtypes pd.read_sql gives the
+    result read at once. Empty frames are left out, categorical columns get the union of the categories,
+    and columns that are only NULL in some frames get the dtype of the values in the others.
+    -----------------------------------------------------------------------
+    Parameters:
+        frames: list
+            pd.DataFrames with the same columns
+
+    ------------------------------------------------------------------------
+    Returns:
+        df: pd.DataFrame
+    """
+    frames = [df for df in frames if len(df)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+
+    # The frames only share a categorical dtype if they have the same categories
+    for column in frames[0].columns:
+        if all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+            categories = pd.api.types.union_categoricals(
+                [df[column] for df in frames], sort_categories=True
+            ).categories
+            dtype = pd.CategoricalDtype(categories)
+            frames = [df.astype({column: dtype}) for df in frames]
+
+    return pd.concat(frames, ignore_index=True).infer_objects()
+
+
+def fetch_source_tables(
+    db_conn, names, get_df=None, compact=False, queries=SOURCE_QUERIES
+):
+    """
+    Reads the sources in names, by the queries of the same name in queries.
+    If db_conn is an engine the queries run concurrently, each on its own connection from the pool of the
+    engine, so that the time is that of the slowest query rather than of all of them. A single connection
+    can not be shared between threads, so with a connection the queries run one after another.
+    -----------------------------------------------------------------------
+    Parameters:
+        db_conn: SQLAlchemy engine or db-connection
+
+        names: list
+            the names of the sources to read, keys of queries
+
+        get_df: function, optional
+            function(table_name, columns=None) returning the contents of a table, e.g. database_import.get_df.
+            If given, the sources in CACHED_SOURCES are read with it instead, so that frames it has cached
+            are reused. The frames it returns are not modified.
+
+        compact: bool, optional
+            Low-memory mode, the sources are read with compact dtypes, see read_sql_compact()
+
+        queries: dict, optional
+            the query of each source, by default SOURCE_QUERIES
+
+    ------------------------------------------------------------------------
+    Returns:
+        sources: dict
+            the pd.DataFrame of each source in names
+    """
+
+    def fetch(name):
+        if get_df is not None and name in CACHED_SOURCES:
+            table_name, columns, renamed = CACHED_SOURCES[name]
+            df = get_df(table_name, columns=columns)
+            df = df.rename(columns=renamed) if renamed else df
+            return compact_dtypes(df) if compact else df
+        if compact:
+            return read_sql_compact(queries[name], db_conn)
+        return pd.read_sql(queries[name], db_conn)
+
+    if len(names) < 2 or not isinstance(db_conn, sqlalchemy.engine.Engine):
+        return {name: fetch(name) for name in names}
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        return dict(zip(names, executor.map(fetch, names)))
+
+
+def get_preprocessed_data_anon(db_conn, get_df=None, sources=None, compact=False):
     """
     See more documentation in Data analysis documentation Google doc  https://docs.google.com/document/d/12GaFIQO7vWYqfqWGpAt7MmugmfwhMc5-nx_11wYU3g4/edit#
 
@@ -41,15 +412,13 @@ def get_preprocessed_data_anon(db_conn):
     ## Background
     Some donors will create several different donor accounts over the years. Ie. They may use different emails, but still register with the same first and last name or ssn. To make the data analysis more representative of reality, we want to merge the donors accounts we believe belong to the same person.
 
-    ### Merging duplicates on first and last name
-    * Donor accounts without names, only whitespaces as names or only a single word as a name will not be matched
-    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of donors with same first and last name. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
-    * We only keep the tax_unit-rows from most_recent_donor
-
-    ### Merging duplicates on ssn
-    * If one donor has several tax_units with identical ssn's we choose the most recent tax_unit, and remove the duplicate
-    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of donors with same ssn. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
+    ### Merging duplicates on first and last name or ssn
+    * Donor accounts without names, only whitespaces as names or only a single word as a name will not be matched on name
+    * Donor accounts are matched on ssn if they have tax_units with the same non-empty, numeric ssn
+    * Matches are transitive: if donor A has the same name as donor B, and donor B has the same ssn as donor C, all three are merged
+    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of merged donors. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
     * We only keep the tax_unit-rows from most_recent_donor
+    * If most_recent_donor has several tax_units with identical ssn's we choose the most recent tax_unit, and remove the duplicate
 
     ### Setting date_registered as the timestamp of the first donation
     * The date_registered column does not always match the timestamp of the first donation. For data analysis purposes, the date_registered column is changed such that it always matches the first registered donation for this donor.
@@ -63,8 +432,20 @@ def get_preprocessed_data_anon(db_conn):
 
     -----------------------------------------------------------------------
     Parameters:
-        db_conn: SQLAlchemy db-connection
-            An active connection to the database
+        db_conn: SQLAlchemy engine or db-connection
+            The database, or an active connection to it. The data is read concurrently from an engine, see fetch_source_tables()
+
+        get_df: function, optional
+            Reads the anonymized tables from this function instead, see fetch_source_tables()
+
+        sources: dict, optional
+            The sources already read by fetch_source_tables(), which are then not read again.
+            They are taken out of the dict and modified, so that each is freed as soon as it has been used
+
+        compact: bool, optional
+            Low-memory mode: IDs are stored as int32 and payment methods, KIDs and genders as categoricals
+            from the moment they are read, see read_sql_compact(). The results are cast back to the usual
+            dtypes before they are returned (see expand_dtypes()), so they are identical to those without it
 
     -------------------------------------------------------------------------
     Returns:
@@ -81,71 +462,85 @@ def get_preprocessed_data_anon(db_conn):
             contains the mapping between the merged donors
 
     """
+    sources = {} if sources is None else sources
+    missing = [name for name in ANON_SOURCES if name not in sources]
+    sources.update(fetch_source_tables(db_conn, missing, get_df, compact))
+    if compact:
+        for name in ANON_SOURCES:
+            sources[name] = compact_dtypes(sources[name])
+
     # Get all donors with at least one donation
-    query = f"""
-            SELECT 
-                d.ID as 'Donor_ID', 
-                d.date_registered, 
-                d.name_ID, 
-                d.has_password,
-                d.is_person,
-                d.is_anon,
-                d.Meta_owner_ID,
-                d.newsletter
-            FROM v_Donors_anon d
-            INNER JOIN Donations ds on d.ID = ds.Donor_ID
-            GROUP BY 
-                d.ID, 
-                d.date_registered, 
-                d.name_ID, 
-                d.has_password,
-                d.is_person,
-                d.is_anon,
-                d.Meta_owner_ID, 
-                d.newsletter
-            """
-    d_raw = pd.read_sql(query, db_conn)
-    d = d_raw.copy()
+    d = sources.pop("donors")
 
     # Get all donations from non-test donors
-    query = """
-        SELECT 
-            ds.* 
-        FROM Donations ds
-        """
-    ds_raw = pd.read_sql(query, db_conn)
-    ds_raw = ds_raw.merge(d[["Donor_ID"]], how="inner", on="Donor_ID")
-    ds = ds_raw.copy()
+    ds = sources.pop("donations")
+    if get_df is not None:
+        ds = ds[ds.Donor_ID.isin(d.Donor_ID)]
 
     # Get all tax_units from non-test donors
-    query = f"""
-        SELECT 
-            tu.* 
-        FROM v_Tax_unit_anon tu
-    """
-    tu_raw = pd.read_sql(query, db_conn)
-    tu_raw = tu_raw.merge(d[["Donor_ID"]], how="inner", on="Donor_ID")
-    tu = tu_raw.copy()
-
-    donor_map = pd.DataFrame(columns=["new_donor_id", "old_donor_id"])
+    tu = sources.pop("tax_units")
+    if get_df is not None:
+        tu = tu[tu.Donor_ID.isin(d.Donor_ID)]
 
     # All anonymous donors get same name_ID
     d.loc[d.is_anon == True, "name_ID"] = d.name_ID.max() + 1
 
-    # Find and merge donors with same first and last name
-    d_grouped = d[["Donor_ID", "name_ID"]].groupby(by="name_ID").count()
-    dups_count = d_grouped[d_grouped.Donor_ID > 1].reset_index()
-    dups_name = dups_count[["name_ID"]].merge(d, how="inner", on="name_ID")
+    # Get the ssn of all tax_units from non-test donors
+    tu_ssn = sources.pop("tax_unit_ssn")
+
+    d_corr, ds_corr, tu_corr, donor_map = preprocess_donor_groups(d, ds, tu, tu_ssn)
+    del d, ds, tu, tu_ssn  # Only the merged frames are used from here on
 
-    d_corr, ds_corr, tu_corr, donor_map = merge_donors(
-        "name_ID", dups_name, d, ds, tu, donor_map
+    d_corr, ds_corr = add_recurring_and_business_flags(
+        d_corr, ds_corr, tu_corr, sources.pop("combining_table")
     )
 
-    # Find and merge donors with same ssn
-    query = f"SELECT * FROM Tax_unit"
-    tu_ssn = pd.read_sql(query, db_conn)
-    tu_ssn = d_corr[["Donor_ID"]].merge(tu_ssn, how="inner", on="Donor_ID")
+    if compact:
+        d_corr, ds_corr, tu_corr, donor_map = map(
+            expand_dtypes, [d_corr, ds_corr, tu_corr, donor_map]
+        )
+
+    check_for_duplicates(d_corr, ds_corr, tu_corr)
+    return d_corr, ds_corr, tu_corr, donor_map
 
+
+def preprocess_donor_groups(d, ds, tu, tu_ssn):
+    """
+    The steps of get_preprocessed_data_anon() that only depend on the donors of each group of duplicates,
+    see find_duplicate_groups(), so that they can be redone for some of the groups only
+    -----------------------------------------------------------------------
+    Parameters:
+        d: pd.DataFrame
+            donors, with the same name_ID for all anonymous donors
+
+        ds: pd.DataFrame
+            donations
+
+        tu: pd.DataFrame
+            tax units
+
+        tu_ssn: pd.DataFrame
+            tax units with ssn, columns ID, Donor_ID and ssn
+
+    ------------------------------------------------------------------------
+    Returns:
+        d_corr: pd.DataFrame
+            filtered and preprosessed donors, without the flags of add_recurring_and_business_flags()
+
+        ds_corr: pd.DataFrame
+            filtered and preprosessed donations, without the flags of add_recurring_and_business_flags()
+
+        tu_corr: pd.DataFrame
+            filtered and and preprosessed tax units
+
+        donor_map: pd.DataFrame
+            contains the mapping between the merged donors
+    """
+    # Find and merge donors with same first and last name or ssn
+    d_corr, ds_corr, tu_corr, donor_map = merge_duplicate_donors(d, ds, tu, tu_ssn)
+
+    # If the same donor has two taxunits with same ssn
+    tu_ssn = tu_ssn[tu_ssn.Donor_ID.isin(d_corr.Donor_ID)]
     count_ssn = tu_ssn[["ID", "ssn"]].groupby("ssn").count()
     count_ssn = count_ssn[
         (count_ssn.index != "")
@@ -153,8 +548,6 @@ def get_preprocessed_data_anon(db_conn):
         & (count_ssn.index.str.isnumeric())
     ]
     dups_ssn = tu_ssn[tu_ssn.ssn.isin(count_ssn.index)][["ID", "Donor_ID", "ssn"]]
-
-    # If the same donor has two taxunits with same ssn
     dups_d_ssn = (
         dups_ssn[["Donor_ID", "ssn"]].drop_duplicates().groupby(by="ssn").count()
     )
@@ -164,12 +557,6 @@ def get_preprocessed_data_anon(db_conn):
     old_tu = tu_dups.drop_duplicates(subset=["ssn", "Donor_ID"], keep="first")
     tu_corr = tu_corr[~tu_corr.ID.isin(old_tu["ID"])]
 
-    # For when different donors have same ssn
-    dups_ssn = dups_ssn.rename(columns={"ID": "tu_ID"})
-    d_corr, ds_corr, tu_corr, donor_map = merge_donors(
-        "ssn", dups_ssn, d_corr, ds_corr, tu_corr, donor_map
-    )
-
     d_corr = set_date_registered_as_first_ds(d_corr, ds_corr)
 
     # Transform to boolean columns
@@ -194,6 +581,35 @@ def get_preprocessed_data_anon(db_conn):
     mult_tu_p = num_tu_p[num_tu_p.ID > 1].index
     d_corr["mult_ssn_tu"] = d_corr.Donor_ID.isin(mult_tu_p)
 
+    return d_corr, ds_corr, tu_corr, donor_map
+
+
+def add_recurring_and_business_flags(d_corr, ds_corr, tu_corr, c_table):
+    """
+    The steps of get_preprocessed_data_anon() that depend on all donations, or on the time they are run:
+    adds the columns is_recurring and has_agreement to d_corr, and from_business to ds_corr
+    -----------------------------------------------------------------------
+    Parameters:
+        d_corr: pd.DataFrame
+            donors from preprocess_donor_groups()
+
+        ds_corr: pd.DataFrame
+            donations from preprocess_donor_groups(), which from_business is added to
+
+        tu_corr: pd.DataFrame
+            tax units from preprocess_donor_groups()
+
+        c_table: pd.DataFrame
+            Combining_table, at least columns KID_fordeling and Tax_unit_ID
+
+    ------------------------------------------------------------------------
+    Returns:
+        d_corr: pd.DataFrame
+
+        ds_corr: pd.DataFrame
+    """
+    tu_corr_business = tu_corr[tu_corr.is_business]
+
     # Add flag for whether donor is classified as recurring
     rec_df = is_recurring(
         d_corr["Donor_ID"].values.tolist(),
@@ -203,23 +619,13 @@ def get_preprocessed_data_anon(db_conn):
     d_corr = d_corr.merge(rec_df, how="left", on="Donor_ID")
 
     # Add a flag for whether donation is from a business
-    query = f"""
-        SELECT
-            c.KID as 'KID_fordeling',
-            c.Tax_unit_ID
-        FROM
-            Combining_table c
-    """
-    c_table = pd.read_sql(query, db_conn).drop_duplicates()
-    ds_corr = ds_corr.merge(c_table, how="left", on="KID_fordeling")
-    ds_corr["from_business"] = ds_corr.Tax_unit_ID.isin(tu_corr_business.ID)
-    ds_corr.drop(["Tax_unit_ID"], axis=1, inplace=True)
+    business_kids = c_table.KID_fordeling[c_table.Tax_unit_ID.isin(tu_corr_business.ID)]
+    ds_corr["from_business"] = ds_corr.KID_fordeling.isin(business_kids)
 
-    check_for_duplicates(d_corr, ds_corr, tu_corr)
-    return d_corr, ds_corr, tu_corr, donor_map
+    return d_corr, ds_corr
 
 
-def get_preprocessed_data(db_conn):
+def get_preprocessed_data(db_conn, get_df=None, compact=False):
     """
     See more documentation in Data analysis documentation Google doc  https://docs.google.com/document/d/12GaFIQO7vWYqfqWGpAt7MmugmfwhMc5-nx_11wYU3g4/edit#
 
@@ -238,15 +644,13 @@ def get_preprocessed_data(db_conn):
     ## Background
     Some donors will create several different donor accounts over the years. Ie. They may use different emails, but still register with the same first and last name or ssn. To make the data analysis more representative of reality, we want to merge the donors accounts we believe belong to the same person.
 
-    ### Merging duplicates on first and last name
-    * Donor accounts without names, only whitespaces as names or only a single word as a name will not be matched
-    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of donors with same first and last name. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
-    * We only keep the tax_unit-rows from most_recent_donor
-
-    ### Merging duplicates on ssn
-    * If one donor has several tax_units with identical ssn's we choose the most recent tax_unit, and remove the duplicate
-    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of donors with same ssn. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
+    ### Merging duplicates on first and last name or ssn
+    * Donor accounts without names, only whitespaces as names or only a single word as a name will not be matched on name
+    * Donor accounts are matched on ssn if they have tax_units with the same non-empty, numeric ssn
+    * Matches are transitive: if donor A has the same name as donor B, and donor B has the same ssn as donor C, all three are merged
+    * We choose to keep only the donor with the most recent donation (aka most_recent_donor) for each group of merged donors. This means that we transfer all donations to this donor, and filter out the other duplicates from the donor dataframe.
     * We only keep the tax_unit-rows from most_recent_donor
+    * If most_recent_donor has several tax_units with identical ssn's we choose the most recent tax_unit, and remove the duplicate
 
     ### Setting date_registered as the timestamp of the first donation
     * The date_registered column does not always match the timestamp of the first donation. For data analysis purposes, the date_registered column is changed such that it always matches the first registered donation for this donor.
@@ -260,8 +664,14 @@ def get_preprocessed_data(db_conn):
 
     -----------------------------------------------------------------------
     Parameters:
-        db_conn: SQLAlchemy db-connection
-            An active connection to the database
+        db_conn: SQLAlchemy engine or db-connection
+            The database, or an active connection to it. The data is read concurrently from an engine, see fetch_source_tables()
+
+        get_df: function, optional
+            Reads the anonymized tables from this function instead, see fetch_source_tables()
+
+        compact: bool, optional
+            Low-memory mode, see get_preprocessed_data_anon()
 
     -----------------------------------------------------------------------
     Returns:
@@ -278,18 +688,334 @@ def get_preprocessed_data(db_conn):
             contains the mapping between the merged donors
 
     """
+    # Read all data at once, including the names add_gender() needs
+    sources = fetch_source_tables(
+        db_conn, ANON_SOURCES + ["donor_names"], get_df, compact
+    )
+    donor_names = sources.pop("donor_names")
+
     # Do all anonymized preprocessing
-    d_corr, ds_corr, tu_corr, donor_map = get_preprocessed_data_anon(db_conn)
+    d_corr, ds_corr, tu_corr, donor_map = get_preprocessed_data_anon(
+        db_conn, get_df=get_df, sources=sources, compact=compact
+    )
 
     # All preprocessing that requires access to non-anonymized data
     # Find gender and add to donor dataframe
-    d_corr = add_gender(d_corr.copy(), tu_corr.copy(), db_conn)
+    d_corr = add_gender(d_corr, tu_corr, db_conn, donor_names=donor_names)
 
     check_for_duplicates(d_corr, ds_corr, tu_corr)
 
     return d_corr, ds_corr, tu_corr, donor_map
 
 
+def read_max_ids(db_conn):
+    """Returns the highest ID of Donations, Tax_unit and Combining_table as a dict, see MAX_ID_QUERY"""
+    max_ids = pd.read_sql(MAX_ID_QUERY, db_conn).iloc[0]
+    return {name: int(max_ids[name]) for name in max_ids.index}
+
+
+def fetch_new_rows(db_conn, watermarks, max_ids, compact=False):
+    """
+    Reads the rows of the sources of get_preprocessed_data_anon() added after the watermarks, up to max_ids,
+    see INCREMENTAL_QUERIES. With all watermarks 0 these are all the rows up to max_ids.
+    """
+    params = {**watermarks, **{f"max_{name}": value for name, value in max_ids.items()}}
+    queries = {
+        name: INCREMENTAL_QUERIES[name].format(**params) for name in ANON_SOURCES
+    }
+    return fetch_source_tables(db_conn, ANON_SOURCES, compact=compact, queries=queries)
+
+
+def build_preprocessing_state(db_conn, compact=False):
+    """
+    Preprocesses all the data like get_preprocessed_data_anon(), and returns the state that
+    update_preprocessing_state() updates with only the new rows instead of preprocessing it all again.
+    -----------------------------------------------------------------------
+    Parameters:
+        db_conn: SQLAlchemy engine or db-connection
+            The database, or an active connection to it. The data is read concurrently from an engine
+
+        compact: bool, optional
+            Low-memory mode, see get_preprocessed_data_anon()
+
+    ------------------------------------------------------------------------
+    Returns:
+        state: dict
+            The frames of STATE_FRAMES: the sources (donors, donations, tax_units, tax_unit_ssn and
+            combining_table), and what preprocess_donor_groups() made of them (donor_groups, tax_units_corr
+            and donor_map). The highest ID read of each table in watermarks, whether it is compact, and when
+            it was last updated (timestamp) and built (full_timestamp).
+    """
+    max_ids = read_max_ids(db_conn)
+    state = fetch_new_rows(db_conn, dict.fromkeys(max_ids, 0), max_ids, compact)
+    if compact:
+        for name in ANON_SOURCES:
+            state[name] = compact_dtypes(state[name])
+
+    # All anonymous donors get same name_ID
+    d = state["donors"]
+    d.loc[d.is_anon == True, "name_ID"] = ANON_NAME_ID
+
+    (
+        state["donor_groups"],
+        _,
+        state["tax_units_corr"],
+        state["donor_map"],
+    ) = preprocess_donor_groups(
+        d, state["donations"], state["tax_units"], state["tax_unit_ssn"]
+    )
+
+    timestamp = datetime.now()
+    state.update(
+        watermarks=max_ids,
+        compact=compact,
+        timestamp=timestamp,
+        full_timestamp=timestamp,
+    )
+    return state
+
+
+def update_preprocessing_state(db_conn, state=None, compact=False):
+    """
+    Updates the state of build_preprocessing_state() with the rows added to the database since it was last
+    updated. Only the groups of duplicate donors (see find_duplicate_groups()) that the new donations and
+    tax units belong to are preprocessed again, which is all that changes when rows are only added.
+
+    Rows that are changed or removed are not seen by the update, so the state is built again from scratch
+    once it is FULL_REBUILD_INTERVAL old, or if the number of donations or tax units in the database no
+    longer matches the state. It is also built again if there is no state, or it is not in the compact mode
+    asked for.
+    -----------------------------------------------------------------------
+    Parameters:
+        db_conn: SQLAlchemy engine or db-connection
+            The database, or an active connection to it
+
+        state: dict, optional
+            The state from build_preprocessing_state() or a previous update, which is modified
+
+        compact: bool, optional
+            Low-memory mode, see get_preprocessed_data_anon()
+
+    ------------------------------------------------------------------------
+    Returns:
+        state: dict
+            The updated state
+    """
+    if (
+        state is None
+        or state["compact"] != compact
+        or datetime.now() - state["full_timestamp"] >= FULL_REBUILD_INTERVAL
+    ):
+        return build_preprocessing_state(db_conn, compact)
+
+    max_ids = read_max_ids(db_conn)
+    watermarks = state["watermarks"]
+    new = fetch_new_rows(db_conn, watermarks, max_ids, compact)
+
+    # Donors and tax units of donors whose first donation is new are read again, but only the new ones are added
+    new_d = new["donors"][~new["donors"].Donor_ID.isin(state["donors"].Donor_ID)].copy()
+    new_tu = new["tax_units"][~new["tax_units"].ID.isin(state["tax_units"].ID)]
+    new_tu_ssn = new["tax_unit_ssn"][
+        ~new["tax_unit_ssn"].ID.isin(state["tax_unit_ssn"].ID)
+    ]
+    new_d.loc[new_d.is_anon == True, "name_ID"] = ANON_NAME_ID
+
+    params = {**watermarks, **{f"max_{name}": value for name, value in max_ids.items()}}
+    row_counts = pd.read_sql(
+        INCREMENTAL_QUERIES["row_counts"].format(**params), db_conn
+    ).iloc[0]
+    if (
+        len(state["donations"]) + len(new["donations"]) != row_counts["donations"]
+        or len(state["tax_units"]) + len(new_tu) != row_counts["tax_units"]
+    ):
+        print("Rows were changed or removed, rebuilding the preprocessing state")
+        return build_preprocessing_state(db_conn, compact)
+
+    d = concat_rows([state["donors"], new_d])
+    ds = concat_rows([state["donations"], new["donations"]])
+    tu = concat_rows([state["tax_units"], new_tu])
+    tu_ssn = concat_rows([state["tax_unit_ssn"], new_tu_ssn])
+    c_table = concat_rows([state["combining_table"], new["combining_table"]])
+    if compact:
+        d, ds, tu, tu_ssn, c_table = map(compact_dtypes, [d, ds, tu, tu_ssn, c_table])
+
+    # The groups of duplicates that new donations or tax units belong to, including groups that they join
+    group = find_duplicate_groups(d, tu_ssn)
+    seeds = (
+        d.Donor_ID.isin(new["donations"].Donor_ID)
+        | d.Donor_ID.isin(new_tu.Donor_ID)
+        | d.Donor_ID.isin(new_tu_ssn.Donor_ID)
+    )
+    affected = d.Donor_ID[np.isin(group, group[seeds.values])]
+
+    d_corr, _, tu_corr, donor_map = preprocess_donor_groups(
+        d[d.Donor_ID.isin(affected)],
+        ds[ds.Donor_ID.isin(affected)],
+        tu[tu.Donor_ID.isin(affected)],
+        tu_ssn[tu_ssn.Donor_ID.isin(affected)],
+    )
+    donor_groups = state["donor_groups"]
+    tax_units_corr = state["tax_units_corr"]
+    old_donor_map = state["donor_map"]
+    state.update(
+        donors=d,
+        donations=ds,
+        tax_units=tu,
+        tax_unit_ssn=tu_ssn,
+        combining_table=c_table,
+        donor_groups=concat_rows(
+            [donor_groups[~donor_groups.Donor_ID.isin(affected)], d_corr]
+        ),
+        tax_units_corr=concat_rows(
+            [tax_units_corr[~tax_units_corr.Donor_ID.isin(affected)], tu_corr]
+        ),
+        donor_map=concat_rows(
+            [old_donor_map[~old_donor_map.old_donor_id.isin(affected)], donor_map]
+        ),
+        watermarks=max_ids,
+        timestamp=datetime.now(),
+    )
+    return state
+
+
+def get_preprocessed_data_from_state(state):
+    """
+    Returns d_corr, ds_corr, tu_corr and donor_map like get_preprocessed_data_anon() from the state of
+    build_preprocessing_state() or update_preprocessing_state(). The flags of add_recurring_and_business_flags()
+    are added to all donors and donations, as is_recurring depends on the time it is run.
+    """
+    d_corr = state["donor_groups"].copy()
+    ds_corr = transfer_donations(state["donations"], state["donor_map"])
+    tu_corr = state["tax_units_corr"].copy()
+    d_corr, ds_corr = add_recurring_and_business_flags(
+        d_corr, ds_corr, tu_corr, state["combining_table"]
+    )
+    donor_map = state["donor_map"].copy()
+    if state["compact"]:
+        d_corr, ds_corr, tu_corr, donor_map = map(
+            expand_dtypes, [d_corr, ds_corr, tu_corr, donor_map]
+        )
+
+    check_for_duplicates(d_corr, ds_corr, tu_corr)
+    return d_corr, ds_corr, tu_corr, donor_map
+
+
+def state_frame_path(path, name, version):
+    return os.path.join(path, f"{name}-{version}.arrow")
+
+
+def save_preprocessing_state(state, path):
+    """
+    Stores the state of update_preprocessing_state() in the directory path: each frame as an Arrow IPC file
+    named by its version, and the rest as state.json. The JSON file is replaced last, so that
+    load_preprocessing_state() never reads a partly written state.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    def write_atomic(file_path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def write_frame(sink, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    version = uuid.uuid4().hex
+    for name in STATE_FRAMES:
+        write_atomic(
+            state_frame_path(path, name, version),
+            lambda sink: write_frame(sink, state[name]),
+        )
+    meta_json = json.dumps(
+        {
+            "version": version,
+            "watermarks": state["watermarks"],
+            "compact": state["compact"],
+            "timestamp": state["timestamp"].isoformat(),
+            "full_timestamp": state["full_timestamp"].isoformat(),
+        }
+    )
+    write_atomic(
+        os.path.join(path, "state.json"), lambda sink: sink.write(meta_json.encode())
+    )
+
+    # Removes the frames of previous versions
+    for entry in os.scandir(path):
+        if entry.name.endswith(".arrow") and not entry.name.endswith(
+            f"-{version}.arrow"
+        ):
+            os.remove(entry.path)
+
+
+def load_preprocessing_state(path):
+    """
+    Returns the state stored by save_preprocessing_state() in the directory path, or None if there is none
+    """
+    try:
+        with open(os.path.join(path, "state.json")) as f:
+            meta = json.load(f)
+        state = {
+            name: pa.ipc.open_file(state_frame_path(path, name, meta["version"]))
+            .read_all()
+            .to_pandas()
+            for name in STATE_FRAMES
+        }
+    except FileNotFoundError:
+        return None
+    state.update(
+        watermarks=meta["watermarks"],
+        compact=meta["compact"],
+        timestamp=datetime.fromisoformat(meta["timestamp"]),
+        full_timestamp=datetime.fromisoformat(meta["full_timestamp"]),
+    )
+    return state
+
+
+def get_preprocessed_data_anon_incremental(db_conn, path, compact=False):
+    """
+    Like get_preprocessed_data_anon(), but only the rows added since the last call are preprocessed, see
+    update_preprocessing_state(). The state is stored in the directory path between calls.
+    -----------------------------------------------------------------------
+    Parameters:
+        db_conn: SQLAlchemy engine or db-connection
+            The database, or an active connection to it
+
+        path: str
+            the directory of the state, see save_preprocessing_state()
+
+        compact: bool, optional
+            Low-memory mode, see get_preprocessed_data_anon()
+
+    ------------------------------------------------------------------------
+    Returns:
+        d_corr, ds_corr, tu_corr, donor_map: pd.DataFrame
+            see get_preprocessed_data_anon()
+    """
+    state = update_preprocessing_state(db_conn, load_preprocessing_state(path), compact)
+    save_preprocessing_state(state, path)
+    return get_preprocessed_data_from_state(state)
+
+
+def get_preprocessed_data_incremental(db_conn, path, compact=False):
+    """
+    Like get_preprocessed_data(), but the anonymized preprocessing is incremental, see
+    get_preprocessed_data_anon_incremental()
+    """
+    d_corr, ds_corr, tu_corr, donor_map = get_preprocessed_data_anon_incremental(
+        db_conn, path, compact
+    )
+    d_corr = add_gender(d_corr, tu_corr, db_conn)
+    check_for_duplicates(d_corr, ds_corr, tu_corr)
+    return d_corr, ds_corr, tu_corr, donor_map
+
+
 def set_date_registered_as_first_ds(d_corr, ds_corr):
     """
     -----------------------------------------------------------------------
@@ -320,31 +1046,112 @@ def set_date_registered_as_first_ds(d_corr, ds_corr):
     return d_corr
 
 
-def merge_donors(var, dups, d_corr, ds_corr, tu_corr, donor_map):
+def find_components(n, a, b):
     """
-    See the docstring of get_preprossed_data_anon() for more details
-    -------------------------------------------------------------
+    Union-find (disjoint set) over the elements 0, ..., n - 1, where element a[i] and b[i] are joined for all i.
+    All pairs are joined at once: the larger root of each pair is hooked under the smaller one, and the paths
+    to the roots are then compressed by pointer jumping. This is repeated until no pair joins two components.
+    -----------------------------------------------------------------------
     Parameters:
-        var: string
-            the variable to find duplicates and merge donors based on
-            can be either ssn or name_ID
+        n: int
+            the number of elements
 
-        dups: pd.DataFrame
-            Containing all the duplicate donors, at least columns var and Donor_ID
+        a, b: np.ndarray
+            the pairs of elements to join, as integer arrays of the same length
 
-        d_corr: pd.DataFrame
-            donors
+    ------------------------------------------------------------------------
+    Returns:
+        root: np.ndarray
+            the root of the component of each element, which is the smallest element of the component
+    """
+    root = np.arange(n)
+    while True:
+        root_a, root_b = root[a], root[b]
+        joins = root_a != root_b
+        if not joins.any():
+            return root
+        np.minimum.at(
+            root,
+            np.maximum(root_a, root_b)[joins],
+            np.minimum(root_a, root_b)[joins],
+        )
+        while True:
+            grandparent = root[root]
+            if (grandparent == root).all():
+                break
+            root = grandparent
 
-        ds_corr: pd.DataFrame
-            donations
 
-        tu_corr: pd.DataFrame
-           tax units
+def find_duplicate_groups(d, tu_ssn):
+    """
+    Donors are duplicates if they have the same name_ID, or tax_units with the same ssn, and duplicates of
+    duplicates are duplicates as well. The groups of duplicates are therefore found in one pass, as the
+    connected components of a union-find over both keys, so that e.g. a donor with the same name as a
+    second donor, who has the same ssn as a third, is merged with both of them.
+    -----------------------------------------------------------------------
+    Parameters:
+        d: pd.DataFrame
+            donors, at least columns Donor_ID and name_ID
 
-        donor_map: pd.DataFrame
-            contains the mapping between the merged donors
+        tu_ssn: pd.DataFrame
+            tax units with ssn, at least columns Donor_ID and ssn
 
-    ------------------------------------------------------------
+    ------------------------------------------------------------------------
+    Returns:
+        group: np.ndarray
+            the group of each donor in d, the same number for all donors of a group
+    """
+    donors = pd.Index(d.Donor_ID)
+
+    # Join each donor with the first donor with the same key, which connects all donors with that key
+    names = d[["Donor_ID", "name_ID"]].dropna()
+    ssns = tu_ssn[["Donor_ID", "ssn"]].dropna()
+    ssns = ssns[(ssns.ssn != "") & (ssns.ssn.str.isnumeric())]
+    keys = [(names, "name_ID"), (ssns, "ssn")]
+    a = np.concatenate([donors.get_indexer(df.Donor_ID) for df, _ in keys])
+    b = np.concatenate(
+        [
+            donors.get_indexer(df.groupby(var).Donor_ID.transform("first"))
+            for df, var in keys
+        ]
+    )
+    return find_components(len(donors), a, b)
+
+
+def transfer_donations(ds, donor_map):
+    """
+    Returns a copy of the donations ds where the donations of merged donors are transferred to the donor
+    they were merged into, by the old_donor_id and new_donor_id of donor_map
+    """
+    new_donor_id = pd.Series(
+        donor_map.new_donor_id.values, index=donor_map.old_donor_id
+    )
+    ds_corr = ds.copy()
+    ds_corr["Donor_ID"] = (
+        ds.Donor_ID.map(new_donor_id).fillna(ds.Donor_ID).astype(ds.Donor_ID.dtype)
+    )
+    return ds_corr
+
+
+def merge_duplicate_donors(d, ds, tu, tu_ssn):
+    """
+    See the docstring of get_preprossed_data_anon() for more details, and find_duplicate_groups() for
+    which donors are duplicates
+    -----------------------------------------------------------------------
+    Parameters:
+        d: pd.DataFrame
+            donors, at least columns Donor_ID and name_ID
+
+        ds: pd.DataFrame
+            donations, at least columns ID, Donor_ID and Timestamp_confirmed
+
+        tu: pd.DataFrame
+            tax units, at least columns Donor_ID and birthdate
+
+        tu_ssn: pd.DataFrame
+            tax units with ssn, at least columns Donor_ID and ssn
+
+    ------------------------------------------------------------------------
     Returns:
         d_corr: pd.DataFrame
             filtered and preprosessed donors
@@ -358,57 +1165,112 @@ def merge_donors(var, dups, d_corr, ds_corr, tu_corr, donor_map):
         donor_map: pd.DataFrame
             contains the mapping between the merged donors
     """
-    ds_dups = dups.merge(ds_corr, how="inner", on="Donor_ID")
-    most_recent = ds_dups.groupby(by=[var]).agg({"Timestamp_confirmed": ["max"]})
-    most_recent.columns = most_recent.columns.droplevel(0)
-    most_recent.rename(columns={"max": "Timestamp_confirmed"}, inplace=True)
-    most_recent.reset_index(inplace=True)
+    donors = d.Donor_ID.values
+    component = find_duplicate_groups(d, tu_ssn)
 
-    most_recent_d = ds_dups.merge(
-        most_recent, how="inner", on=[var, "Timestamp_confirmed"]
+    # The most recent donor of each group is the donor with the most recent donation, or with
+    # the highest donation ID if several donors have donations with the same timestamp
+    last_ds = ds[["Donor_ID", "Timestamp_confirmed", "ID"]].sort_values(
+        by=["Timestamp_confirmed", "ID"]
     )
-    most_recent_d = most_recent_d.sort_values(by=[var, "Timestamp_confirmed", "ID"])
-    most_recent_d = most_recent_d.drop_duplicates(
-        subset=[var, "Timestamp_confirmed"], keep="last"
+    last_ds = last_ds.drop_duplicates(subset="Donor_ID", keep="last")
+    group = pd.DataFrame({"Donor_ID": donors, "component": component}).merge(
+        last_ds, how="left", on="Donor_ID"
     )
-
-    most_recent_d = most_recent_d[["Donor_ID", var]].drop_duplicates(keep="last")
-    most_recent_d.rename(columns={"Donor_ID": "most_recent_id"}, inplace=True)
-    most_recent_d = most_recent_d.merge(dups[[var, "Donor_ID"]], how="inner", on=var)
-
-    # Remove most recent donor from the dataframe, since only need to change the other duplicates
-    most_recent_d = most_recent_d[
-        most_recent_d.most_recent_id != most_recent_d.Donor_ID
-    ]
+    most_recent_d = group.sort_values(
+        by=["Timestamp_confirmed", "ID"], na_position="first"
+    ).drop_duplicates(subset="component", keep="last")
+    most_recent_id = pd.Series(
+        most_recent_d.Donor_ID.values, index=most_recent_d.component.values
+    )
+    group["most_recent_id"] = most_recent_id[group.component].values
 
     # Create a dict that maps all donors that are merged
-    donor_map = pd.concat(
-        [
-            donor_map,
-            most_recent_d[["most_recent_id", "Donor_ID"]].rename(
-                columns={"most_recent_id": "new_donor_id", "Donor_ID": "old_donor_id"}
-            ),
-        ]
+    merged = group[group.most_recent_id != group.Donor_ID]
+    donor_map = pd.DataFrame(
+        {
+            "new_donor_id": merged.most_recent_id.values,
+            "old_donor_id": merged.Donor_ID.values,
+        }
     )
 
     # Transfer all donations to the most recent donor
-    ds_corr = ds_corr.merge(most_recent_d, how="left", on="Donor_ID")
-    ds_corr.loc[ds_corr.most_recent_id.notnull(), "Donor_ID"] = ds_corr.most_recent_id
-    ds_corr.drop(["most_recent_id", var], axis=1, inplace=True)
+    ds_corr = transfer_donations(ds, donor_map)
 
     # Remove all other donors than most_recent_donor from tax_unit dataframe
-    tu_corr = tu_corr[~tu_corr.Donor_ID.isin(donor_map.old_donor_id)]
+    tu_corr = tu[~tu.Donor_ID.isin(donor_map.old_donor_id)]
 
     # Set correct data-type for birthdate
     tu_corr = tu_corr.astype({"birthdate": "datetime64[ns]"})
 
     # Remove all other donors than most_recent_donor from donor-dataframe
-    d_corr = d_corr[~d_corr.Donor_ID.isin(donor_map.old_donor_id)]
+    d_corr = d[~d.Donor_ID.isin(donor_map.old_donor_id)]
 
     return d_corr, ds_corr, tu_corr, donor_map
 
 
-def add_gender(d, tu, db_conn):
+def read_gendered_names(path=GENDERED_NAMES_FILE):
+    """
+    Reads the names file as a dict from lowercase first name to whether it is a girl name.
+    Names that are on both lists are boy names.
+    """
+    gender_df = pd.read_csv(path)
+    gendered_names = dict.fromkeys(
+        gender_df["Jentenavn"].dropna().str.strip().str.lower(), True
+    )
+    gendered_names.update(
+        dict.fromkeys(gender_df["Guttenavn"].dropna().str.strip().str.lower(), False)
+    )
+    return gendered_names
+
+
+def guess_female_from_names(donor_names, path=GENDERED_NAMES_FILE):
+    """
+    Guesses the gender of donors from their first name, which is the first word of the full name up to any hyphen.
+    Donors classified by an earlier call with the same full name and names file are not classified again.
+    -----------------------------------------------------------------------
+    Parameters:
+        donor_names: pd.DataFrame
+            DataFrame with columns ID and full_name
+
+        path: string, optional
+            the names file, see read_gendered_names()
+
+    ------------------------------------------------------------------------
+    Returns:
+        female_name: pd.Series
+            True for girl names, False for boy names and NaN for other names, indexed by donor ID
+    """
+    global name_genders, name_genders_file
+    names_file = (os.path.abspath(path), os.path.getmtime(path))
+    full_names = pd.Series(donor_names.full_name.values, index=donor_names.ID.values)
+
+    with name_genders_lock:
+        if name_genders_file == names_file:
+            known = name_genders.reindex(full_names.index)
+        else:
+            known = pd.DataFrame(
+                {"full_name": None, "female_name": np.nan},
+                index=full_names.index,
+                dtype=object,
+            )
+
+    # Only new and renamed donors are classified
+    renamed = known.full_name.ne(full_names)
+    if renamed.any():
+        gendered_names = read_gendered_names(path)
+        first_names = (
+            full_names[renamed].str.extract(r"^\s*([^\s-]*)", expand=False).str.lower()
+        )
+        known.loc[renamed, "full_name"] = full_names[renamed]
+        known.loc[renamed, "female_name"] = first_names.map(gendered_names)
+
+    with name_genders_lock:
+        name_genders, name_genders_file = known, names_file
+    return known.female_name
+
+
+def add_gender(d, tu, db_conn, donor_names=None):
     """
     -----------------------------------------------------------------------
     Parameters:
@@ -420,6 +1282,9 @@ def add_gender(d, tu, db_conn):
 
         db_conn: SQLAlchemy db-connection
 
+        donor_names: pd.DataFrame, optional
+            The result of SOURCE_QUERIES["donor_names"], if already read
+
 
     ------------------------------------------------------------------------
     Returns:
@@ -428,25 +1293,15 @@ def add_gender(d, tu, db_conn):
             The boolean column female indicates whether the donor is female or not
             based on ssn (if available) and first name
     """
-    # Gendered names
-    gender_df = pd.read_csv("../GenderedNames.csv")
-    gender_df["Guttenavn"] = gender_df["Guttenavn"].str.strip().str.lower()
-    gender_df["Jentenavn"] = gender_df["Jentenavn"].str.strip().str.lower()
-
-    # All donors
-    query = f"SELECT d.ID, d.full_name FROM Donors d where d.full_name is not NULL and not d.full_name=''"
-    d_db = pd.read_sql(query, db_conn)
-    d_db["first_name"] = d_db.full_name.str.split().str[0]
-    d_db["first_name"] = d_db.first_name.str.split("-").str[0].str.strip().str.lower()
-
-    # Find gender for all donors
-    d_db.loc[d_db.first_name.isin(gender_df.Jentenavn), "female_name"] = True
-    d_db.loc[d_db.first_name.isin(gender_df.Guttenavn), "female_name"] = False
-    d_db.rename(columns={"ID": "Donor_ID"}, inplace=True)
+    # Gender based on names, only needed for donors who are individual people
+    if donor_names is None:
+        donor_names = pd.read_sql(SOURCE_QUERIES["donor_names"], db_conn)
+    ind_person = d[(d.mult_ssn_tu == False) & (d.is_person == True)]
+    donor_names = donor_names[donor_names.ID.isin(ind_person.Donor_ID)]
+    d_db = guess_female_from_names(donor_names).rename("female_name")
+    d_db = d_db.rename_axis("Donor_ID").reset_index()
 
     # Find gender for input donors based on names
-    # only donors who are individual people can have gender
-    ind_person = d[(d.mult_ssn_tu == False) & (d.is_person == True)]
     ind_person = ind_person.merge(
         d_db[["Donor_ID", "female_name"]], how="left", on="Donor_ID"
     )
@@ -524,22 +1379,40 @@ def is_recurring(d_ids, donations, timestamp):
         & (donations.Timestamp_confirmed <= timestamp)
     ]
 
-    # Get all donors that have not donated in the last 35 days
-    non_rec_d_ids = [
-        donor_id for donor_id in d_ids if donor_id not in donations_35.Donor_ID.values
-    ]
-
     # Get all donors that have donated during the last 35 days with Vipps recurring, AvtaleGiro or PayPal
     agreement_rec_d_ids = donations_35[
         donations_35.Payment_ID.isin([3, 7, 8])
     ].Donor_ID.unique()
 
-    non_agreement_rec_d_ids = []
+    # The remaining donors have donated during the last 35 days, but not with an agreement
+    remaining_donations = donations[
+        donations.Donor_ID.isin(donations_35.Donor_ID)
+        & ~donations.Donor_ID.isin(agreement_rec_d_ids)
+    ]
+    non_agreement_rec_d_ids = find_non_agreement_recurring(
+        remaining_donations, timestamp
+    )
+
+    rec_d_ids = np.append(agreement_rec_d_ids, non_agreement_rec_d_ids)
+
+    # Create a dataframe with Donor_ID, is_recurring and has_agreement columns and incldue all donors
+    rec_donor_df = pd.DataFrame(
+        {"Donor_ID": d_ids, "is_recurring": False, "has_agreement": False}
+    )
+    rec_donor_df.loc[rec_donor_df.Donor_ID.isin(rec_d_ids), "is_recurring"] = True
+    rec_donor_df.loc[
+        rec_donor_df.Donor_ID.isin(agreement_rec_d_ids), "has_agreement"
+    ] = True
+
+    return rec_donor_df
 
-    remaining_d_ids = list(set(d_ids) - set(non_rec_d_ids) - set(agreement_rec_d_ids))
 
-    for donor_id in remaining_d_ids:
-        """
+def find_non_agreement_recurring(donations, timestamp):
+    """
+    Finds the donors that were recurring at timestamp without an agreement, see is_recurring().
+    All donors are handled at once with grouped operations, instead of looping over them.
+
+    For each donor:
         A refers to last donation before the timestamp
         B refers to a donation that is at least 20 days before donation A or 20 days after donation A
         C refers to a donation that is at least:
@@ -547,125 +1420,360 @@ def is_recurring(d_ids, donations, timestamp):
             or
             20 days after the latest of donation A and donation B
 
-        If A, B and C are all found, the donor is a recurring donor at the time of the specified timestamp.
-        """
-        donor_donations = donations[donations.Donor_ID == donor_id]
-        donation_A_timestamp = donor_donations[
-            donor_donations.Timestamp_confirmed <= timestamp
-        ].Timestamp_confirmed.max()
-        # Get all donations from donor that are at least 20 days prior to or after donation A
-        donations_20_days_prior_A = donor_donations[
-            donor_donations.Timestamp_confirmed
-            <= donation_A_timestamp - pd.Timedelta(days=20)
-        ]
-        donations_20_days_after_A = donor_donations[
-            donor_donations.Timestamp_confirmed
-            >= donation_A_timestamp + pd.Timedelta(days=20)
-        ]
+    If A, B and C are all found within 65 days, the donor is a recurring donor at the time of the specified timestamp.
+    Looking backwards in time the best choice of B and C is the latest donation satisfying each condition,
+    and looking forwards in time the earliest. If neither direction satisfies the requirements by itself,
+    B is the first donation at least 20 days after A and C the last donation at least 20 days before A.
 
-        if donations_20_days_prior_A.empty and donations_20_days_after_A.empty:
-            # There is no donation at least 20 days before or after donation A
-            continue
-
-        if not donations_20_days_prior_A.empty:
-            # Only checking backwards in time
-            donation_B_timestamp = donations_20_days_prior_A.Timestamp_confirmed.max()
-            donations_20_days_prior_B = donations_20_days_prior_A[
-                donations_20_days_prior_A.Timestamp_confirmed
-                <= donation_B_timestamp - pd.Timedelta(days=20)
-            ]
-            if not donations_20_days_prior_B.empty:
-                # There is a donation at least 20 days before donation B
-                donation_C_timestamp = (
-                    donations_20_days_prior_B.Timestamp_confirmed.max()
-                )
-                if (donation_A_timestamp - donation_C_timestamp).days <= 65:
-                    # The donation A, B and C were within 65 days of each other
-                    non_agreement_rec_d_ids = np.append(
-                        non_agreement_rec_d_ids, donor_id
-                    )
-                    continue
-
-        if not donations_20_days_after_A.empty:
-            # Only checking forwards in time
-            donation_B_timestamp = donations_20_days_after_A.Timestamp_confirmed.min()
-            donations_20_days_after_B = donations_20_days_after_A[
-                donations_20_days_after_A.Timestamp_confirmed
-                >= donation_B_timestamp + pd.Timedelta(days=20)
-            ]
-            if not donations_20_days_after_B.empty:
-                # There is a donation at least 20 days after donation B
-                donation_C_timestamp = (
-                    donations_20_days_after_B.Timestamp_confirmed.min()
-                )
-                if (donation_C_timestamp - donation_A_timestamp).days <= 65:
-                    # The donation A, B and C were within 65 days of each other
-                    non_agreement_rec_d_ids = np.append(
-                        non_agreement_rec_d_ids, donor_id
-                    )
-                    continue
+    -----------------------------------------------------------------------
+    Parameters:
+        donations: pd.DataFrame
+            The donations of the donors to check within 101 days before and 65 days after timestamp,
+            where each donor has at least one donation before timestamp.
+            Columns Donor_ID and Timestamp_confirmed
 
-        if donations_20_days_after_A.empty or donations_20_days_prior_A.empty:
-            continue
+        timestamp: pd.Timestamp
+            The point in time for which to determine the recurring status
 
-        # There are donations both before and after donation A, but no direction satisfies the requirements by itself
-        donation_B_timestamp = donations_20_days_after_A.Timestamp_confirmed.min()
-        donation_C_timestamp = donations_20_days_prior_A.Timestamp_confirmed.max()
+    ---------------------------------------------------------------------------
+    Returns:
+        rec_d_ids: np.array
+            The ids of the donors that were recurring at timestamp
+    """
+    codes, d_ids = pd.factorize(donations.Donor_ID)
+    timestamps = donations.Timestamp_confirmed.reset_index(drop=True)
+    days_20 = pd.Timedelta(days=20)
+
+    def latest(mask):
+        # Latest timestamp per donor among the donations in mask, NaT if there are none
+        return timestamps.where(mask).groupby(codes).max()
+
+    def earliest(mask):
+        return timestamps.where(mask).groupby(codes).min()
+
+    def per_donation(per_donor):
+        return per_donor.to_numpy()[codes]
+
+    donation_A = latest(timestamps <= timestamp)
+    # Backwards in time
+    donation_B_prior = latest(timestamps <= per_donation(donation_A) - days_20)
+    donation_C_prior = latest(timestamps <= per_donation(donation_B_prior) - days_20)
+    # Forwards in time
+    donation_B_after = earliest(timestamps >= per_donation(donation_A) + days_20)
+    donation_C_after = earliest(timestamps >= per_donation(donation_B_after) + days_20)
+
+    # Comparisons with NaT, when a donation is missing, are False
+    is_rec = (
+        ((donation_A - donation_C_prior).dt.days <= 65)
+        | ((donation_C_after - donation_A).dt.days <= 65)
+        | ((donation_B_after - donation_B_prior).dt.days <= 65)
+    )
+    return np.asarray(d_ids)[is_rec.to_numpy()]
 
-        if (donation_B_timestamp - donation_C_timestamp).days <= 65:
-            # The donation A, B and C were within 65 days of each other
-            non_agreement_rec_d_ids = np.append(non_agreement_rec_d_ids, donor_id)
 
-    rec_d_ids = np.append(agreement_rec_d_ids, non_agreement_rec_d_ids)
+def recurring_status_over_time(d_ids, donations, timestamps, output="long"):
+    """
+    Determines whether the donors in d_ids were recurring donors, and whether due to an agreement, at each of
+    the timestamps. The definition is the same as in is_recurring(), which this gives the same results as for
+    every timestamp, but the donations are only sorted once. For each timestamp only the donors who donated
+    during the 35 days before it are looked up, by binary search in the sorted donations.
 
-    # Create a dataframe with Donor_ID, is_recurring and has_agreement columns and incldue all donors
-    rec_donor_df = pd.DataFrame(
-        {"Donor_ID": d_ids, "is_recurring": False, "has_agreement": False}
+    -----------------------------------------------------------------------
+    Parameters:
+        d_ids: list
+            A list of containing all the donor ids whose recurring status are to be determined
+
+        donations: pd.DataFrame
+            All donations relevant for determining the recurring status of d_ids.
+            Columns Donor_ID, Timestamp_confirmed and Payment_ID
+
+        timestamps: list-like of pd.Timestamp
+            The points in time for which to determine the recurring status, e.g. pd.date_range(..., freq="M")
+
+        output: string
+            "long" or "matrix", see below
+
+    ---------------------------------------------------------------------------
+    Returns:
+        output="long":
+            rec_df: pd.DataFrame
+                With columns timestamp, Donor_ID, has_agreement.
+                One row for each donor that was recurring at each timestamp, donors that were not are left out
+
+        output="matrix":
+            is_recurring: pd.DataFrame
+                Boolean DataFrame with d_ids as index and timestamps as columns
+            has_agreement: pd.DataFrame
+                Same shape as is_recurring
+    """
+    timestamps = pd.DatetimeIndex(timestamps)
+    donations = donations[
+        donations.Donor_ID.isin(d_ids) & donations.Timestamp_confirmed.notna()
+    ]
+    codes, donors = pd.factorize(donations.Donor_ID)
+    ts = donations.Timestamp_confirmed.to_numpy().astype("datetime64[ns]").view("int64")
+    is_agreement = donations.Payment_ID.isin([3, 7, 8]).to_numpy()
+
+    # Donations are sorted by donor and then time, as keys combining the donor with the rank of the timestamp
+    unique_ts = np.unique(ts)
+    n_ranks = len(unique_ts) + 1
+    keys = codes.astype("int64") * n_ranks + np.searchsorted(unique_ts, ts)
+    order = np.argsort(keys, kind="stable")
+    keys, sorted_ts = keys[order], ts[order]
+    agreement_keys, agreement_ts = (
+        keys[is_agreement[order]],
+        sorted_ts[is_agreement[order]],
     )
-    rec_donor_df.loc[rec_donor_df.Donor_ID.isin(rec_d_ids), "is_recurring"] = True
-    rec_donor_df.loc[
-        rec_donor_df.Donor_ID.isin(agreement_rec_d_ids), "has_agreement"
-    ] = True
+    # And by time only, to find the donors who donated in a period
+    time_order = np.argsort(ts, kind="stable")
+    ts_by_time, codes_by_time = ts[time_order], codes[time_order]
+
+    def last_at_or_before(keys, donor_codes, t):
+        # Position in keys of the last donation of each donor at or before t, -1 if there is none
+        if len(keys) == 0:
+            return np.full(len(donor_codes), -1)
+        rank = np.searchsorted(unique_ts, t, side="right")
+        pos = np.searchsorted(keys, donor_codes * n_ranks + rank, side="left") - 1
+        found = (pos >= 0) & (keys[np.maximum(pos, 0)] // n_ranks == donor_codes)
+        return np.where(found, pos, -1)
+
+    def first_at_or_after(donor_codes, t):
+        # Position in keys of the first donation of each donor at or after t, -1 if there is none
+        rank = np.searchsorted(unique_ts, t, side="left")
+        pos = np.searchsorted(keys, donor_codes * n_ranks + rank, side="left")
+        found = (pos < len(keys)) & (
+            keys[np.minimum(pos, len(keys) - 1)] // n_ranks == donor_codes
+        )
+        return np.where(found, pos, -1)
+
+    day = pd.Timedelta(days=1).value
+    rec_rows = []
+    for timestamp in timestamps:
+        t = timestamp.value
+        lower, upper = t - 101 * day, t + 65 * day
+
+        # Donors that have donated during the last 35 days
+        start = np.searchsorted(ts_by_time, t - 35 * day, side="left")
+        end = np.searchsorted(ts_by_time, t, side="right")
+        donor_codes = np.unique(codes_by_time[start:end])
+
+        # Of those, the donors that donated with Vipps recurring, AvtaleGiro or PayPal
+        pos = last_at_or_before(agreement_keys, donor_codes, t)
+        has_agreement = pos >= 0
+        has_agreement[has_agreement] = agreement_ts[pos[has_agreement]] >= t - 35 * day
+
+        # The others are recurring if donations A, B and C are found, see find_non_agreement_recurring().
+        # Donations outside lower and upper are not considered.
+        remaining = donor_codes[~has_agreement]
+        donation_A = sorted_ts[last_at_or_before(keys, remaining, t)]
+        pos = last_at_or_before(keys, remaining, donation_A - 20 * day)
+        prior_B_found = (pos >= 0) & (sorted_ts[pos] >= lower)
+        donation_B_prior = sorted_ts[pos]
+        pos = last_at_or_before(keys, remaining, donation_B_prior - 20 * day)
+        prior_C_found = prior_B_found & (pos >= 0) & (sorted_ts[pos] >= lower)
+        donation_C_prior = sorted_ts[pos]
+        pos = first_at_or_after(remaining, donation_A + 20 * day)
+        after_B_found = (pos >= 0) & (sorted_ts[pos] <= upper)
+        donation_B_after = sorted_ts[pos]
+        pos = first_at_or_after(remaining, donation_B_after + 20 * day)
+        after_C_found = after_B_found & (pos >= 0) & (sorted_ts[pos] <= upper)
+        donation_C_after = sorted_ts[pos]
+
+        # Within 65 days, counted in whole days like Timedelta.days
+        within_65_days = lambda first, last: last - first < 66 * day
+        is_rec = (
+            (prior_C_found & within_65_days(donation_C_prior, donation_A))
+            | (after_C_found & within_65_days(donation_A, donation_C_after))
+            | (
+                prior_B_found
+                & after_B_found
+                & within_65_days(donation_B_prior, donation_B_after)
+            )
+        )
+
+        rec_codes = np.concatenate([donor_codes[has_agreement], remaining[is_rec]])
+        rec_rows.append(
+            pd.DataFrame(
+                {
+                    "timestamp": timestamp,
+                    "code": rec_codes,
+                    "has_agreement": np.arange(len(rec_codes)) < has_agreement.sum(),
+                }
+            )
+        )
+
+    rec_df = pd.concat(rec_rows, ignore_index=True) if rec_rows else None
+    if output == "long":
+        if rec_df is None:
+            return pd.DataFrame(columns=["timestamp", "Donor_ID", "has_agreement"])
+        rec_df.insert(1, "Donor_ID", np.asarray(donors)[rec_df.code.to_numpy()])
+        return rec_df.drop(columns=["code"])
+    if output != "matrix":
+        raise ValueError(f"output must be 'long' or 'matrix', not {output!r}")
+
+    is_rec = np.zeros((len(donors), len(timestamps)), dtype=bool)
+    has_agreement = np.zeros((len(donors), len(timestamps)), dtype=bool)
+    if rec_df is not None:
+        columns = timestamps.get_indexer(rec_df.timestamp)
+        is_rec[rec_df.code.to_numpy(), columns] = True
+        has_agreement[rec_df.code.to_numpy(), columns] = rec_df.has_agreement.to_numpy()
+    # Donors without donations were never recurring
+    is_rec = pd.DataFrame(is_rec, index=donors, columns=timestamps).reindex(
+        d_ids, fill_value=False
+    )
+    has_agreement = pd.DataFrame(
+        has_agreement, index=donors, columns=timestamps
+    ).reindex(d_ids, fill_value=False)
+    return is_rec, has_agreement
 
-    return rec_donor_df
 
+def get_distribution_percentages(db_conn, org_id=None, version=None):
+    """
+    Reads the percentage share of the organizations in the distribution of each KID.
+    If version is given, the shares of all organizations are read once for that version of the data,
+    and kept until they are asked for with another version, so that version must change whenever the
+    distributions do.
+    -----------------------------------------------------------------------
+    Parameters:
+        db_conn: SQLAlchemy engine or db-connection
 
-def get_direct_GE_ds_percentages(db_conn):
-    query = """
+        org_id: int, optional
+            only the shares of this organization, or of all organizations if None
+
+        version: optional
+            the version of the data, see database_import.get_versioned_df()
+
+    ------------------------------------------------------------------------
+    Returns:
+        percentages: pd.DataFrame
+            Columns KID_fordeling, OrgId and percent
+    """
+    global distribution_percentages, distribution_percentages_version
+    org_filter = (
+        ""
+        if org_id is None or version is not None
+        else f"WHERE dist.OrgId = {int(org_id)}"
+    )
+    query = f"""
         SELECT
             c.KID as 'KID_fordeling',
-            dist.percentage_share as 'GE_percent'
+            dist.OrgId,
+            dist.percentage_share as 'percent'
         FROM
             Combining_table c
         INNER JOIN Distribution dist ON dist.ID = c.Distribution_ID
-        WHERE dist.OrgId = 11  
+        {org_filter}
+    """
+    if version is None:
+        return pd.read_sql(query, db_conn)
+
+    with distribution_percentages_lock:
+        if distribution_percentages_version != version:
+            distribution_percentages = pd.read_sql(query, db_conn)
+            distribution_percentages_version = version
+        percentages = distribution_percentages
+    if org_id is None:
+        return percentages
+    return percentages[percentages.OrgId == org_id]
+
+
+def get_direct_GE_ds_percentages(db_conn, version=None):
+    direct_GE = get_distribution_percentages(db_conn, GE_ORG_ID, version)
+    return direct_GE[["KID_fordeling", "percent"]].rename(
+        columns={"percent": "GE_percent"}
+    )
+
+
+def split_donations_by_org(donations, db_conn, org_id=GE_ORG_ID, version=None):
+    """
+    Splits donations into the part given to the organization org_id and the part given to the others,
+    by the percentage share of the organization in the distribution of the KID of each donation.
+    -----------------------------------------------------------------------
+    Parameters:
+        donations: pd.DataFrame
+            DataFrame with at least columns KID_fordeling and Sum_confirmed
+
+        db_conn: SQLAlchemy engine or db-connection
+
+        org_id: int, optional
+            the organization, by default direct donations to GiveWell
+
+        version: optional
+            caches the distributions for this version of the data, see get_distribution_percentages()
+
+    ------------------------------------------------------------------------
+    Returns:
+        donations_other: pd.DataFrame
+            The donations not only to org_id, with Sum_confirmed set to the amount given to the other organizations
+
+        donations_org: pd.DataFrame
+            The donations at least partly to org_id, with Sum_confirmed set to the amount given to org_id
     """
-    direct_GE = pd.read_sql(query, db_conn)
-    return direct_GE
+    donations_split, percent = merge_org_percent(donations, db_conn, org_id, version)
+    return (
+        scale_by_percent(donations_split, 100 - percent),
+        scale_by_percent(donations_split, percent),
+    )
 
 
-def remove_direct_GE_donations(donations, db_conn):
-    direct_GE = get_direct_GE_ds_percentages(db_conn)
-    donations_orgs = donations.merge(direct_GE, how="left", on="KID_fordeling")
-    donations_orgs["GE_percent"] = donations_orgs.GE_percent.fillna(0)
-    donations_orgs = donations_orgs[donations_orgs.GE_percent != 100]
-    donations_orgs["Sum_confirmed"] = (
-        donations_orgs["Sum_confirmed"] * 0.01 * (100 - donations_orgs["GE_percent"])
+def merge_org_percent(donations, db_conn, org_id, version=None):
+    """
+    Returns donations merged with the distributions, and the percentage share of org_id in the distribution
+    of each donation, 0 if it has none, see split_donations_by_org()
+    """
+    percentages = get_distribution_percentages(db_conn, org_id, version)
+    donations_split = donations.merge(
+        percentages[["KID_fordeling", "percent"]], how="left", on="KID_fordeling"
     )
-    donations_orgs.drop(["GE_percent"], axis=1, inplace=True)
-    return donations_orgs
+    percent = donations_split.pop("percent").fillna(0)
+    return donations_split, percent
 
 
-def extract_direct_GE_donations(donations, db_conn):
-    direct_GE = get_direct_GE_ds_percentages(db_conn)
-    donations_GE = donations.merge(direct_GE, how="left", on="KID_fordeling")
-    donations_GE["GE_percent"] = donations_GE.GE_percent.fillna(0)
-    donations_GE = donations_GE[donations_GE.GE_percent != 0]
-    donations_GE["Sum_confirmed"] = (
-        donations_GE["Sum_confirmed"] * 0.01 * (donations_GE["GE_percent"])
+def scale_by_percent(donations, percent):
+    # New frame of the donations with a share, with Sum_confirmed set to that share of it
+    share = percent != 0
+    return donations[share].assign(
+        Sum_confirmed=donations["Sum_confirmed"][share] * 0.01 * percent[share]
     )
-    donations_GE.drop(["GE_percent"], axis=1, inplace=True)
-    return donations_GE
+
+
+def split_donations_per_org(donations, db_conn, version=None):
+    """
+    Splits each donation into the amounts given to each organization in the distribution of its KID.
+    -----------------------------------------------------------------------
+    Parameters:
+        donations: pd.DataFrame
+            DataFrame with at least columns KID_fordeling and Sum_confirmed
+
+        db_conn: SQLAlchemy engine or db-connection
+
+        version: optional
+            caches the distributions for this version of the data, see get_distribution_percentages()
+
+    ------------------------------------------------------------------------
+    Returns:
+        donations_orgs: pd.DataFrame
+            One row for each organization of each donation, with an extra column OrgId, and Sum_confirmed
+            set to the amount given to that organization. Donations without a distribution are kept whole,
+            with OrgId NaN
+    """
+    percentages = get_distribution_percentages(db_conn, version=version)
+    donations_orgs = donations.merge(percentages, how="left", on="KID_fordeling")
+    percent = donations_orgs.pop("percent").fillna(100)
+    donations_orgs["Sum_confirmed"] = donations_orgs["Sum_confirmed"] * 0.01 * percent
+    return donations_orgs
+
+
+def remove_direct_GE_donations(donations, db_conn, version=None):
+    # Only the half of split_donations_by_org() that is not given to GiveWell
+    donations_split, percent = merge_org_percent(donations, db_conn, GE_ORG_ID, version)
+    return scale_by_percent(donations_split, 100 - percent)
+
+
+def extract_direct_GE_donations(donations, db_conn, version=None):
+    # Only the half of split_donations_by_org() that is given to GiveWell
+    donations_split, percent = merge_org_percent(donations, db_conn, GE_ORG_ID, version)
+    return scale_by_percent(donations_split, percent)
 
 
 def remove_anonymous_donations(donations, donors):
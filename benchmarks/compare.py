@@ -0,0 +1,45 @@
+"""
+Compares two result files of benchmarks/run.py, and exits with status 1 if any case got slower or used
+more memory than --threshold allows.
+
+    python benchmarks/compare.py baseline.json results.json --threshold 0.2
+"""
+import argparse
+import json
+import sys
+
+def case_name(result):
+    return result['stage'] if result['case'] is None else f"{result['stage']} {json.dumps(result['case'], sort_keys=True)}"
+
+def load(path):
+    with open(path) as f:
+        return {case_name(result): result for result in json.load(f)['results']}
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative increase of the median time and peak memory (default 0.2)')
+    args = parser.parse_args()
+
+    baseline, results = load(args.baseline), load(args.results)
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name}: new")
+            continue
+        old = baseline[name]
+        time_ratio = result['wall_seconds']['median'] / max(old['wall_seconds']['median'], 1e-9)
+        memory_ratio = result['peak_memory_bytes'] / max(old['peak_memory_bytes'], 1)
+        print(f"{name}: time x{time_ratio:.2f} ({result['wall_seconds']['median']:.4f}s), memory x{memory_ratio:.2f} ({result['peak_memory_bytes']:,} bytes)")
+        if time_ratio > 1 + args.threshold or memory_ratio > 1 + args.threshold:
+            regressions.append(name)
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}:")
+        for name in regressions:
+            print(f"  {name}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Benchmarks the dashboard on synthetic data (see synthetic_data.py), and writes the results as JSON.
+
+    python benchmarks/run.py --donations 1000000 --output results.json
+
+Stages:
+    app_import, app_warmup: importing app, and until the warm-up has loaded all data
+    histogram: histogram_plot.get_histogram for several slider windows, with and without one-time donations
+    sankey: budgets_plot.plot_sankey for each year
+    organizations: organizations_plot.get_plot
+    yearly_growth: yearly_growth_plot.get_yearly_donations_plot
+    preprocessing: dbutils.get_preprocessed_data_anon, also in its compact mode, and refreshing its incremental state
+    is_recurring: dbutils.is_recurring for all preprocessed donors at the time of the last donation
+
+Each case is timed --repeat times, and run once more with tracemalloc to measure its peak memory, since
+tracing slows it down. The callbacks run with the data cached, like after the warm-up. Compare two result
+files with benchmarks/compare.py.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['app_import', 'app_warmup', 'histogram', 'sankey', 'organizations', 'yearly_growth', 'preprocessing', 'is_recurring']
+
+def measure(fn, repeat):
+    """Returns the wall times of repeat calls of fn, the peak memory of one more traced call, and the last result"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak, result
+
+def output_size(result):
+    # Size of the JSON sent to the browser for figures
+    return len(result.to_json()) if hasattr(result, 'to_json') else None
+
+def summary(stage, case, times, peak, result=None):
+    return {
+        'stage': stage,
+        'case': case,
+        'wall_seconds': {'min': min(times), 'median': statistics.median(times), 'runs': times},
+        'peak_memory_bytes': peak,
+        'output_bytes': output_size(result),
+    }
+
+def run_app_import(trace):
+    # Run in a fresh interpreter by measure_app_import, as importing is only slow the first time
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    import app
+    import_seconds = time.perf_counter() - start
+    import warmup
+    warmup.ready.wait()
+    warmup_seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if trace else None
+    print(json.dumps({'import_seconds': import_seconds, 'warmup_seconds': warmup_seconds, 'peak_memory_bytes': peak}))
+
+def measure_app_import(repeat):
+    runs = []
+    for trace in [False] * repeat + [True]:
+        # Every run starts without snapshots, like a new deployment
+        env = {**os.environ, 'SNAPSHOT_DIR': tempfile.mkdtemp(prefix='benchmark-snapshots-')}
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--app-import-child'] + (['--trace'] if trace else []),
+                                cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    timed, traced = runs[:-1], runs[-1]
+    return [
+        summary('app_import', None, [run['import_seconds'] for run in timed], traced['peak_memory_bytes']),
+        summary('app_warmup', None, [run['warmup_seconds'] for run in timed], traced['peak_memory_bytes']),
+    ]
+
+def histogram_windows(n_months):
+    # Slider windows as (first month, last month) indexes
+    last = n_months - 1
+    return {
+        'all': [0, last],
+        'first_year': [0, min(11, last)],
+        'last_year': [max(last - 11, 0), last],
+        'last_quarter': [max(last - 3, 0), last],
+        'middle_half': [n_months // 4, 3 * n_months // 4],
+    }
+
+def run_stages(stages, repeat):
+    import database_import as dbi
+    import plotting.histogram_plot as histogram_plot
+    import plotting.budgets_plot as budgets_plot
+    import plotting.organizations_plot as organizations_plot
+    import plotting.yearly_growth_plot as yearly_growth_plot
+    sys.path.insert(0, os.path.join(ROOT, 'assets'))
+    import dbutils
+
+    results = []
+    if 'histogram' in stages:
+        for name, window in histogram_windows(len(histogram_plot.get_month_marks())).items():
+            for exclude_otd in [False, True]:
+                times, peak, fig = measure(lambda: histogram_plot.get_histogram(window, exclude_otd), repeat)
+                results.append(summary('histogram', {'window': name, 'months': window, 'exclude_otd': exclude_otd}, times, peak, fig))
+    if 'sankey' in stages:
+        for budget in budgets_plot.budgets_:
+            times, peak, fig = measure(lambda: budgets_plot.plot_sankey(budget.year), repeat)
+            results.append(summary('sankey', {'year': budget.year}, times, peak, fig))
+    if 'organizations' in stages:
+        times, peak, fig = measure(organizations_plot.get_plot, repeat)
+        results.append(summary('organizations', None, times, peak, fig))
+    if 'yearly_growth' in stages:
+        times, peak, fig = measure(yearly_growth_plot.get_yearly_donations_plot, repeat)
+        results.append(summary('yearly_growth', None, times, peak, fig))
+    if 'preprocessing' in stages or 'is_recurring' in stages:
+        # With the engine, so that the tables are read concurrently
+        preprocess = lambda: dbutils.get_preprocessed_data_anon(dbi.engine)
+        times, peak, (d_corr, ds_corr, tu_corr, donor_map) = measure(preprocess, repeat)
+        if 'preprocessing' in stages:
+            results.append(summary('preprocessing', {'donors': len(d_corr), 'donations': len(ds_corr)}, times, peak))
+            times, peak, _ = measure(lambda: dbutils.get_preprocessed_data_anon(dbi.engine, compact=True), repeat)
+            results.append(summary('preprocessing', {'donors': len(d_corr), 'donations': len(ds_corr), 'compact': True}, times, peak))
+            # Refreshes with no new rows, after the state has been built once
+            state_dir = tempfile.mkdtemp(prefix='benchmark-preprocessing-state-')
+            dbutils.get_preprocessed_data_anon_incremental(dbi.engine, state_dir)
+            times, peak, _ = measure(lambda: dbutils.get_preprocessed_data_anon_incremental(dbi.engine, state_dir), repeat)
+            results.append(summary('preprocessing', {'donors': len(d_corr), 'donations': len(ds_corr), 'incremental': True}, times, peak))
+    if 'is_recurring' in stages:
+        d_ids = d_corr['Donor_ID'].values.tolist()
+        donations = ds_corr[['Donor_ID', 'Timestamp_confirmed', 'Payment_ID']]
+        timestamp = ds_corr['Timestamp_confirmed'].max()
+        times, peak, _ = measure(lambda: dbutils.is_recurring(d_ids, donations, timestamp), repeat)
+        results.append(summary('is_recurring', {'donors': len(d_ids)}, times, peak))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the dashboard on synthetic data.')
+    parser.add_argument('--donations', type=int, default=100000, help='Number of synthetic donations (default 100000)')
+    parser.add_argument('--db', default=None, help='Synthetic database to use, generated if it does not exist (default in the temporary directory)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each case (default 3)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default all)')
+    parser.add_argument('--output', default=None, help='File to write the JSON results to (default stdout)')
+    parser.add_argument('--app-import-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--trace', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT) # The pages read files relative to the project directory
+    if args.app_import_child:
+        return run_app_import(args.trace)
+
+    db_path = args.db or os.path.join(tempfile.gettempdir(), f"benchmark-synthetic-{args.donations}.db")
+    if not os.path.exists(db_path):
+        import synthetic_data
+        synthetic_data.generate(db_path, args.donations)
+    # Set before database_import is imported, by the subprocesses as well
+    os.environ['DB_BACKEND'] = 'sqlite'
+    os.environ['SQLITE_PATH'] = db_path
+    os.environ['SNAPSHOT_DIR'] = tempfile.mkdtemp(prefix='benchmark-snapshots-')
+
+    results = []
+    with contextlib.redirect_stdout(sys.stderr): # Keep the log of the app out of the JSON
+        if 'app_import' in args.stages or 'app_warmup' in args.stages:
+            results += [result for result in measure_app_import(args.repeat) if result['stage'] in args.stages]
+        results += run_stages(args.stages, args.repeat)
+
+    report = json.dumps({
+        'meta': {
+            'donations': args.donations,
+            'db': db_path,
+            'repeat': args.repeat,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+if __name__ == '__main__':
+    main()
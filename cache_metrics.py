@@ -0,0 +1,67 @@
+import bisect
+import copy
+from threading import Lock
+
+# Upper bounds in seconds of the buckets of the fetch latency histograms
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+metrics = {}
+lock = Lock()
+
+def new_table_metrics():
+    return {
+        'hits': 0, # Requests answered with fresh cached data
+        'stale_hits': 0, # Requests answered with expired cached data while it was refreshed
+        'misses': 0, # Requests that had to query the database themselves
+        'waits': 0, # Requests that waited for another thread's query
+        'wait_seconds': 0.0,
+        'snapshot_loads': 0, # Loads of a snapshot written by another process
+        'fetches': 0, # Queries against the database
+        'fetch_seconds': 0.0,
+        'fetch_latency_histogram': [0] * (len(LATENCY_BUCKETS) + 1), # Last bucket counts fetches slower than all bounds
+        'rows_fetched': 0,
+        'bytes_fetched': 0,
+    }
+
+def increment(table_name, **amounts):
+    with lock:
+        table_metrics = metrics.setdefault(table_name, new_table_metrics())
+        for name, amount in amounts.items():
+            table_metrics[name] += amount
+
+def record_hit(table_name, stale=False):
+    increment(table_name, **{'stale_hits' if stale else 'hits': 1})
+
+def record_miss(table_name):
+    increment(table_name, misses=1)
+
+def record_wait(table_name, seconds):
+    increment(table_name, waits=1, wait_seconds=seconds)
+
+def record_snapshot_load(table_name):
+    increment(table_name, snapshot_loads=1)
+
+def record_fetch(table_name, seconds, rows, bytes):
+    with lock:
+        table_metrics = metrics.setdefault(table_name, new_table_metrics())
+        table_metrics['fetches'] += 1
+        table_metrics['fetch_seconds'] += seconds
+        table_metrics['fetch_latency_histogram'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        table_metrics['rows_fetched'] += rows
+        table_metrics['bytes_fetched'] += bytes
+
+def get_table_metrics():
+    """
+    Returns a copy of the metrics of each table, as a dict from table name to counters.
+    fetch_latency_histogram is returned as a dict from bucket upper bound ('+Inf' for the last) to count.
+    """
+    with lock:
+        table_metrics = copy.deepcopy(metrics)
+    for counters in table_metrics.values():
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        counters['fetch_latency_histogram'] = dict(zip(bounds, counters['fetch_latency_histogram']))
+    return table_metrics
+
+def reset():
+    with lock:
+        metrics.clear()
@@ -1,58 +1,469 @@
 import sqlalchemy as db
 import pandas as pd
+import cache_metrics
+import snapshot_store
 import os
-from datetime import datetime, timedelta
-from threading import Lock
 import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Condition, Lock, Thread
 
 engine = None
 
 print("K_SERVICE: ", os.getenv('K_SERVICE'))
 
+# Local stand-in database generated by synthetic_data.py, selected with DB_BACKEND=sqlite
+if os.getenv('DB_BACKEND') == 'sqlite':
+    import synthetic_data
+    engine = synthetic_data.create_engine(os.getenv('SQLITE_PATH', 'synthetic.db'))
 # Check if running in google cloud, by checking the environment variable K_SERVICE
-if os.getenv('K_SERVICE') is not None:
+elif os.getenv('K_SERVICE') is not None:
     engine = db.create_engine(os.environ['DB_CONNECTION_STRING'])
 else:
     host = 'host.docker.internal' # Requires that the host machine is running google cloud proxy
     database = 'EffektAnalysisDB'
     engine = db.create_engine(f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{host}/{database}")
 
-cache = {}
+# Projections of the Donations and Scorecard_Organization_donations tables used by the dashboard pages.
+# Pages should request exactly these projections so that they share a single cache entry.
+DONATIONS_COLUMNS = ['Timestamp_confirmed', 'Sum_confirmed', 'Donor_ID']
+# Donor_ID is nullable, so that donations without a donor do not make the whole fetch fail
+DONATIONS_DTYPES = {'Timestamp_confirmed': 'datetime64[ns]', 'Sum_confirmed': 'float64', 'Donor_ID': 'Int32'}
+SCORECARD_COLUMNS = ['Timestamp', 'Org', 'Amount']
+SCORECARD_DTYPES = {'Timestamp': 'datetime64[ns]', 'Amount': 'float64'}
+
+CACHE_TTL = timedelta(hours=12)
+
+# Tables that only get rows appended, with the columns that can be used as a high-water mark, in order of
+# preference. When such a projection expires only rows above the watermark are fetched and appended, so
+# these projections can be refreshed much more often.
+WATERMARK_COLUMNS = {
+    'Donations': ['ID', 'Timestamp_confirmed'],
+}
+INCREMENTAL_TTL = timedelta(minutes=10)
+FULL_RELOAD_INTERVAL = timedelta(hours=12) # Incrementally refreshed projections are still fully reloaded this often
+
+# TTL overrides per table, taking precedence over CACHE_TTL and INCREMENTAL_TTL
+TABLE_TTL = {}
+
+# Seconds a request waits for another thread to fetch data that is not cached yet, before it gives up
+CACHE_WAIT_TIMEOUT = float(os.getenv('CACHE_WAIT_TIMEOUT', 120))
+
+# Bytes of cached data each process may hold before the least recently used entries are evicted
+CACHE_MEMORY_BUDGET = int(os.getenv('CACHE_MEMORY_BUDGET', 512 * 1024**2))
+
+def data_size(entry):
+    return int(entry['data'].memory_usage(index=True, deep=True).sum()) if 'data' in entry else 0
+
+class LRUCache():
+    """
+    Dict-like store of cache entries, which keeps the total size of their data within memory_budget bytes by
+    evicting the least recently used entries. Entries being queried are never evicted, and neither is the
+    entry just stored. Not thread safe, only use it while holding lock.
+
+    Data loaded from a snapshot is memory mapped, and on Cloud Run the snapshot directory is in memory, so
+    evicting such an entry also removes its snapshot. Otherwise dropping the data would free nothing.
+    """
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.sizes = {}
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __setitem__(self, key, entry):
+        if key in self.entries and self.entries[key].get('data') is entry.get('data'):
+            size = self.sizes[key] # Measuring object columns is expensive, so avoid it if the data is unchanged
+        else:
+            size = data_size(entry)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.evict(keep=key)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+        del self.sizes[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def footprint(self):
+        """Returns the total size of the cached data in bytes"""
+        return sum(self.sizes.values())
+
+    def evict(self, keep):
+        for key in list(self.entries): # Least recently used first
+            if self.footprint() <= self.memory_budget:
+                break
+            if key == keep or 'querying' in self.entries[key]:
+                continue
+            print(f"Evicting {key[0]} from the cache ({self.sizes[key]:,} bytes)")
+            version = self.entries[key].get('version')
+            del self[key]
+            if version is not None:
+                snapshot_store.remove_snapshot(key, version)
+
+cache = LRUCache(CACHE_MEMORY_BUDGET)
 lock = Lock()
+cache_updated = Condition(lock) # Notified whenever a cache entry is stored or removed
+
+def make_cache_key(table_name, columns=None, date_range=None, ids=None, dtypes=None, date_column='Timestamp_confirmed', id_column='ID'):
+    # Every projection/filter combination is cached separately
+    return (
+        table_name,
+        tuple(columns) if columns is not None else None,
+        (date_column, tuple(date_range)) if date_range is not None else None,
+        (id_column, tuple(sorted(ids))) if ids is not None else None,
+        tuple(sorted((col, str(dtype)) for col, dtype in dtypes.items())) if dtypes is not None else None,
+    )
+
+def to_sql_value(value):
+    # The DB driver does not know how to escape numpy and pandas scalars
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+def build_query(table_name, columns=None, date_range=None, ids=None, date_column='Timestamp_confirmed', id_column='ID', after=None, count=False):
+    """
+    Builds a SELECT on table_name that only transfers the requested columns and rows.
+
+    columns: list of column names to select, None selects all columns
+    date_range: (start, end) tuple selecting rows with start <= date_column < end, either bound may be None
+    ids: iterable of values of id_column to select
+    after: (column, value) tuple selecting rows with column > value
+    count: select the number of matching rows instead of the rows
+    """
+    table = db.table(table_name, *[db.column(col) for col in columns or []])
+    if count:
+        query = db.select(db.func.count()).select_from(table)
+    elif columns is not None:
+        query = db.select(*[table.c[col] for col in columns])
+    else:
+        query = db.select(db.text('*')).select_from(table)
+
+    if date_range is not None:
+        start, end = date_range
+        if start is not None:
+            query = query.where(db.column(date_column) >= to_sql_value(start))
+        if end is not None:
+            query = query.where(db.column(date_column) < to_sql_value(end))
+    if ids is not None:
+        query = query.where(db.column(id_column).in_([to_sql_value(id) for id in ids]))
+    if after is not None:
+        column, value = after
+        query = query.where(db.column(column) > to_sql_value(value))
+    return query
+
+def read_sql(table_name, query):
+    # Runs query, recording its latency and the size of the result in cache_metrics
+    start = time.perf_counter()
+    with engine.connect() as con:
+        df = pd.read_sql(query, con=con)
+    cache_metrics.record_fetch(table_name, time.perf_counter() - start, len(df), int(df.memory_usage(index=True, deep=True).sum()))
+    return df
+
+def fetch_df(table_name, columns=None, date_range=None, ids=None, dtypes=None, date_column='Timestamp_confirmed', id_column='ID', after=None):
+    query = build_query(table_name, columns=columns, date_range=date_range, ids=ids, date_column=date_column, id_column=id_column, after=after)
+    df = read_sql(table_name, query)
+    if dtypes is not None:
+        df = df.astype(dtypes)
+    return df
+
+def count_rows(table_name, date_range=None, ids=None, date_column='Timestamp_confirmed', id_column='ID'):
+    query = build_query(table_name, date_range=date_range, ids=ids, date_column=date_column, id_column=id_column, count=True)
+    start = time.perf_counter()
+    with engine.connect() as con:
+        count = con.execute(query).scalar()
+    cache_metrics.record_fetch(table_name, time.perf_counter() - start, rows=0, bytes=0)
+    return count
+
+def period_expression(column, freq):
+    # The day, or the first day of the month, of a timestamp column
+    if freq == 'D':
+        return db.func.date(column)
+    if engine.dialect.name == 'sqlite':
+        return db.func.strftime('%Y-%m-01', column)
+    return db.func.date_format(column, '%Y-%m-01')
+
+def build_aggregate_query(table_name, value_column, freq, recurring_only=False, date_column='Timestamp_confirmed', donor_column='Donor_ID'):
+    """
+    Builds a query summing value_column per day (freq='D') or month (freq='M') of date_column.
+    With recurring_only only the rows of donors with more than one row are summed.
+    """
+    table = db.table(table_name, db.column(value_column), db.column(date_column), db.column(donor_column))
+    period = period_expression(table.c[date_column], freq).label('period')
+    # Group by the alias, as MySQL does not see two bound DATE_FORMAT expressions as the same
+    query = db.select(period, db.func.sum(table.c[value_column]).label(value_column)).group_by(db.literal_column('period')).order_by(db.literal_column('period'))
+    if recurring_only:
+        donors = table.alias('recurring_donors')
+        recurring_donors = db.select(donors.c[donor_column]).group_by(donors.c[donor_column]).having(db.func.count() > 1)
+        query = query.where(table.c[donor_column].in_(recurring_donors))
+    return query
+
+def fetch_aggregate(table_name, value_column, freq, recurring_only=False, date_column='Timestamp_confirmed', donor_column='Donor_ID'):
+    query = build_aggregate_query(table_name, value_column, freq, recurring_only=recurring_only, date_column=date_column, donor_column=donor_column)
+    df = read_sql(table_name, query)
 
-def get_df(table_name):
+    # Same shape as resampling the rows with pandas: every period is present, and months are labelled by their last day
+    sums = pd.Series(df[value_column].astype('float64').to_numpy(), index=pd.to_datetime(df['period']))
+    if freq == 'M':
+        sums.index = sums.index + pd.offsets.MonthEnd(0)
+    sums = sums.asfreq(freq, fill_value=0.0)
+    return pd.DataFrame({date_column: sums.index, value_column: sums.to_numpy()})
+
+def get_watermark_column(table_name, columns=None):
+    # The watermark column has to be part of the projection, so that its maximum is known
+    for column in WATERMARK_COLUMNS.get(table_name, []):
+        if columns is None or column in columns:
+            return column
+    return None
+
+def get_ttl(table_name, columns=None):
+    if table_name in TABLE_TTL:
+        return TABLE_TTL[table_name]
+    return INCREMENTAL_TTL if get_watermark_column(table_name, columns) is not None else CACHE_TTL
+
+def fetch_entry(entry, table_name, dtypes=None, **query):
+    """
+    Fetches a fresh cache entry for a projection from the database, given its previous cache entry.
+
+    Projections with a watermark column are refreshed by only fetching rows above the stored watermark.
+    If the table no longer has as many rows as we hold after appending the new ones (rows have been deleted,
+    or inserted below the watermark), or the last full load is older than FULL_RELOAD_INTERVAL, the
+    projection is reloaded in full instead. If no rows were added the data and version of entry are kept.
+    """
+    watermark_column = get_watermark_column(table_name, query.get('columns'))
+    now = datetime.now()
+    if entry.get('watermark') is not None and now - entry['full_timestamp'] < FULL_RELOAD_INTERVAL:
+        print(f"Fetching new rows for {table_name}")
+        new_rows = fetch_df(table_name, dtypes=dtypes, after=(watermark_column, entry['watermark']), **query)
+        filters = {k: v for k, v in query.items() if k != 'columns'} # Counting does not depend on the projection
+        if count_rows(table_name, **filters) == len(entry['data']) + len(new_rows):
+            if new_rows.empty:
+                return {**entry, 'timestamp': now}
+            df = pd.concat([entry['data'], new_rows], ignore_index=True)
+            return {'data': df, 'version': None, 'timestamp': now, 'full_timestamp': entry['full_timestamp'], 'watermark': df[watermark_column].max()}
+        print(f"Rows of {table_name} were removed or inserted out of order, reloading")
+
+    print(f"Fetching data for {table_name}")
+    df = fetch_df(table_name, dtypes=dtypes, **query)
+    watermark = df[watermark_column].max() if watermark_column is not None and not df.empty else None
+    return {'data': df, 'version': None, 'timestamp': now, 'full_timestamp': now, 'watermark': watermark}
+
+def new_entry(df):
+    # Cache entry for data fetched in full
+    now = datetime.now()
+    return {'data': df, 'version': None, 'timestamp': now, 'full_timestamp': now, 'watermark': None}
+
+def read_snapshot_entry(key, entry, watermark_column=None):
+    # Returns a cache entry for the current snapshot of key, reusing the data of entry if it is the same version
+    meta = snapshot_store.read_meta(key)
+    if meta is None:
+        return None
+    if meta['version'] == entry.get('version'):
+        return {**entry, 'timestamp': meta['timestamp'], 'full_timestamp': meta['full_timestamp']}
+
+    df = snapshot_store.read_data(key, meta['version'])
+    if df is None:
+        return None # Replaced by a newer version since we read the metadata
+    watermark = df[watermark_column].max() if watermark_column is not None and not df.empty else None
+    return {'data': df, 'version': meta['version'], 'timestamp': meta['timestamp'], 'full_timestamp': meta['full_timestamp'], 'watermark': watermark}
+
+def load_entry(key, entry, table_name, ttl, fetch, watermark_column=None):
+    """
+    Returns a fresh cache entry for key, given its previous cache entry in this process.
+    fetch(entry) fetches a fresh entry from the database, given the latest entry.
+
+    All worker processes share a snapshot of each cache entry through snapshot_store. If the snapshot is
+    fresh it is used as is. Otherwise one process fetches from the database while holding the snapshot lock
+    and writes a new snapshot, which the other processes pick up once they get the lock.
+    """
+    entry = {k: v for k, v in entry.items() if k != 'querying'}
+    snapshot = read_snapshot_entry(key, entry, watermark_column)
+    if snapshot is not None and datetime.now() - snapshot['timestamp'] < ttl:
+        print(f"Loading snapshot of {table_name}")
+        cache_metrics.record_snapshot_load(table_name)
+        return snapshot
+
+    with snapshot_store.locked(key):
+        # Another process may have refreshed the snapshot while we were waiting for the lock
+        snapshot = read_snapshot_entry(key, entry, watermark_column)
+        if snapshot is not None and datetime.now() - snapshot['timestamp'] < ttl:
+            print(f"Loading snapshot of {table_name}")
+            cache_metrics.record_snapshot_load(table_name)
+            return snapshot
+
+        fetched = fetch(snapshot or entry)
+        if fetched['version'] is not None:
+            # Nothing new, only the timestamps of the snapshot are updated
+            snapshot_store.write_snapshot(key, table_name, fetched)
+            return fetched
+        version = snapshot_store.write_snapshot(key, table_name, fetched, df=fetched['data'])
+
+    # Continue with the memory mapped snapshot, so that this process shares it as well
+    return read_snapshot_entry(key, {}, watermark_column) or {**fetched, 'version': version}
+
+def refresh_in_background(key, stale_entry, table_name, ttl, fetch, watermark_column=None):
+    # stale_entry is the cache entry marked as querying. If it has been invalidated by the time the refresh
+    # finishes, the result is thrown away
+    def refresh():
+        try:
+            entry = load_entry(key, stale_entry, table_name, ttl, fetch, watermark_column)
+        except Exception as e:
+            print(f"Refreshing {table_name} failed, keeping stale data: {e}")
+            entry = {k: v for k, v in stale_entry.items() if k != 'querying'}
+        with lock:
+            if cache.get(key) is stale_entry:
+                cache[key] = entry
+                cache_updated.notify_all()
+
+    Thread(target=refresh, name=f"refresh-{table_name}", daemon=True).start()
+
+def get_cached(key, table_name, ttl, fetch, watermark_column=None):
+    """
+    Returns the cached data for key and its version, see load_entry for fetch and watermark_column.
+
+    Expired data is still returned while it is refreshed on a background thread. Only when nothing is cached
+    yet does the caller block, and then only one thread queries the database while the others wait for it.
+    They wait at most CACHE_WAIT_TIMEOUT seconds, then raise TimeoutError, so that a stalled query does not
+    block every request thread.
+    """
+    wait_start = None
     with lock:
-        current_time = datetime.now()
-        cache_entry = cache.get(table_name, {})
-        # Check if data is already being queried or is in cache and still valid
-        if 'querying' in cache_entry:
-            should_wait = True
-        elif 'data' in cache_entry and (current_time - cache_entry['timestamp']) < timedelta(hours=12):
-            print(f"Returning cached data for {table_name}")
-            return cache_entry['data']
-        else:
-            # Mark as querying and proceed to fetch
-            cache[table_name] = {'querying': True}
-            should_wait = False
-
-    if should_wait:
-        # Wait for data to be available
-        print(f"Waiting for {table_name} data to be cached")
-        start = datetime.now()
-        while 'querying' in cache.get(table_name, {}):
-            time.sleep(0.1)  # Adjust sleep time as needed
-            if datetime.now() - start > timedelta(seconds=30):  # Timeout after 30 seconds
-                print(f"Timeout while waiting for {table_name}. Attempting to fetch directly.")
-                break  # Break the loop and attempt to fetch the data directly
-
-    # Fetch and cache data
+        while True:
+            cache_entry = cache.get(key, {})
+            if 'data' in cache_entry or 'querying' not in cache_entry:
+                if wait_start is not None:
+                    cache_metrics.record_wait(table_name, time.perf_counter() - wait_start)
+            if 'data' in cache_entry:
+                if 'querying' in cache_entry:
+                    print(f"Returning stale data for {table_name} while it is refreshed")
+                    cache_metrics.record_hit(table_name, stale=True)
+                elif datetime.now() - cache_entry['timestamp'] >= ttl:
+                    print(f"Returning stale data for {table_name} and refreshing it")
+                    cache_metrics.record_hit(table_name, stale=True)
+                    stale_entry = {**cache_entry, 'querying': True}
+                    cache[key] = stale_entry
+                    refresh_in_background(key, stale_entry, table_name, ttl, fetch, watermark_column)
+                else:
+                    print(f"Returning cached data for {table_name}")
+                    cache_metrics.record_hit(table_name)
+                return cache_entry['data'], cache_entry['version']
+            if 'querying' not in cache_entry:
+                # Nothing cached, and no one else is fetching it
+                cache_metrics.record_miss(table_name)
+                marker = {'querying': True}
+                cache[key] = marker
+                break
+            print(f"Waiting for {table_name} data to be cached")
+            if wait_start is None:
+                wait_start = time.perf_counter()
+            remaining = wait_start + CACHE_WAIT_TIMEOUT - time.perf_counter()
+            if remaining <= 0:
+                cache_metrics.record_wait(table_name, time.perf_counter() - wait_start)
+                raise TimeoutError(f"Timed out waiting {CACHE_WAIT_TIMEOUT:g} s for {table_name} data to be cached")
+            cache_updated.wait(remaining)
+
+    try:
+        cache_entry = load_entry(key, {}, table_name, ttl, fetch, watermark_column)
+    except Exception:
+        with lock:
+            if cache.get(key) is marker:
+                del cache[key] # Let one of the waiting threads try instead
+                cache_updated.notify_all()
+        raise
+
     with lock:
-        # Check again if data is now available or still needs fetching
-        if 'data' not in cache.get(table_name, {}) or datetime.now() - cache[table_name]['timestamp'] > timedelta(hours=12):
-            print(f"Fetching data for {table_name}")
-            df = pd.read_sql_table(table_name=table_name, con=engine.connect())
-            cache[table_name] = {'data': df, 'timestamp': datetime.now()}
-        else:
-            df = cache[table_name]['data']
+        if cache.get(key) is marker:
+            cache[key] = cache_entry
+            cache_updated.notify_all()
+    return cache_entry['data'], cache_entry['version']
+
+def get_versioned_df(table_name, columns=None, date_range=None, ids=None, dtypes=None, date_column='Timestamp_confirmed', id_column='ID'):
+    """
+    Returns the (cached) contents of table_name, and the version of the data. The version changes whenever
+    the data does, and is the same in all worker processes.
+
+    Only the given columns are fetched, and only rows within date_range (start inclusive, end exclusive)
+    on date_column and with id_column in ids. The filters are pushed into the SQL query, and dtypes is
+    applied to the result. Each combination of arguments is cached separately, for the TTL given by get_ttl.
+    """
+    key = make_cache_key(table_name, columns=columns, date_range=date_range, ids=ids, dtypes=dtypes, date_column=date_column, id_column=id_column)
+    query = dict(columns=columns, date_range=date_range, ids=ids, date_column=date_column, id_column=id_column)
+    fetch = lambda entry: fetch_entry(entry, table_name, dtypes=dtypes, **query)
+    return get_cached(key, table_name, get_ttl(table_name, columns), fetch, get_watermark_column(table_name, columns))
+
+def get_versioned_aggregate(table_name, value_column, freq, recurring_only=False, date_column='Timestamp_confirmed', donor_column='Donor_ID'):
+    """
+    Returns the (cached) sums of value_column per day (freq='D') or month (freq='M'), and the version of the data.
+    The sums are computed by the database, so only one row per period is transferred. The result has columns
+    date_column and value_column, with months labelled by their last day like pandas' resample('M').
+    With recurring_only only the rows of donors with more than one row in the table are summed.
+    """
+    key = (table_name, 'aggregate', value_column, freq, recurring_only, date_column, donor_column)
+    fetch = lambda entry: new_entry(fetch_aggregate(table_name, value_column, freq, recurring_only=recurring_only, date_column=date_column, donor_column=donor_column))
+    return get_cached(key, table_name, get_ttl(table_name), fetch)
 
+def get_aggregate(table_name, value_column, freq, recurring_only=False, date_column='Timestamp_confirmed', donor_column='Donor_ID'):
+    """Returns the (cached) sums of value_column per day or month, see get_versioned_aggregate"""
+    df, version = get_versioned_aggregate(table_name, value_column, freq, recurring_only=recurring_only, date_column=date_column, donor_column=donor_column)
     return df
+
+def get_df(table_name, columns=None, date_range=None, ids=None, dtypes=None, date_column='Timestamp_confirmed', id_column='ID'):
+    """Returns the (cached) contents of table_name, see get_versioned_df"""
+    df, version = get_versioned_df(table_name, columns=columns, date_range=date_range, ids=ids, dtypes=dtypes, date_column=date_column, id_column=id_column)
+    return df
+
+def invalidate(table_name=None):
+    """
+    Removes all cached projections of table_name, or of all tables if table_name is None,
+    so that they are fetched in full on the next request. The shared snapshots are removed as well.
+    """
+    snapshot_store.remove_snapshots(table_name)
+    with lock:
+        for key in [key for key in cache if table_name is None or key[0] == table_name]:
+            del cache[key]
+        cache_updated.notify_all()
+
+def get_cache_footprint():
+    """Returns the total size in bytes of the data cached by this process"""
+    with lock:
+        return cache.footprint()
+
+def get_metrics():
+    """
+    Returns the cache and query metrics of this process as a JSON serializable dict:
+        cache_bytes, cache_memory_budget: size of the cached data and the budget it is kept within
+        tables: dict from table name to the counters of cache_metrics.get_table_metrics, plus
+            cached_entries, cached_bytes: number and size of the cached projections and aggregates of the table
+            cache_age_seconds: time since the oldest of them was fetched, None if nothing is cached
+    """
+    tables = cache_metrics.get_table_metrics()
+    for table in tables.values():
+        table.update({'cached_entries': 0, 'cached_bytes': 0, 'cache_age_seconds': None})
+    now = datetime.now()
+    with lock:
+        for key in cache:
+            entry = cache.entries[key]
+            if 'data' not in entry or key[0] not in tables:
+                continue # Still being fetched for the first time
+            table = tables[key[0]]
+            table['cached_entries'] += 1
+            table['cached_bytes'] += cache.sizes[key]
+            age = (now - entry['timestamp']).total_seconds()
+            table['cache_age_seconds'] = max(age, table['cache_age_seconds'] or 0)
+        footprint = cache.footprint()
+    return {'cache_bytes': footprint, 'cache_memory_budget': CACHE_MEMORY_BUDGET, 'tables': tables}
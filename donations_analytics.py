@@ -0,0 +1,63 @@
+import pandas as pd
+from threading import Lock
+import database_import as dbi
+
+def prepare_analytics(df):
+    """
+    Derives everything the pages need from the donations projection (see dbi.DONATIONS_COLUMNS).
+
+    Returns a dict with
+        df: donations sorted by Timestamp_confirmed, with it as DatetimeIndex
+        df_recurring: the donations of donors with more than one donation
+        donor_counts: number of donations per Donor_ID
+
+    Sums per day or month are computed by the database instead, see get_sums.
+    """
+    df = df.sort_values(by='Timestamp_confirmed')
+    df.index = pd.DatetimeIndex(df['Timestamp_confirmed'])
+
+    donor_counts = df['Donor_ID'].value_counts()
+    # Donations without a Donor_ID are not counted, and never recurring
+    df_recurring = df[df['Donor_ID'].map(donor_counts).fillna(0).to_numpy() > 1]
+
+    return {
+        'df': df,
+        'df_recurring': df_recurring,
+        'donor_counts': donor_counts,
+    }
+
+analytics = None
+lock = Lock()
+
+def get_analytics():
+    """
+    Returns the output of prepare_analytics for the cached donations, with the data version under 'version'.
+    It is computed once per data version and shared by all pages.
+    """
+    global analytics
+    df, version = dbi.get_versioned_df(table_name='Donations', columns=dbi.DONATIONS_COLUMNS, dtypes=dbi.DONATIONS_DTYPES)
+    with lock:
+        if analytics is None or analytics['version'] != version:
+            analytics = {'version': version, **prepare_analytics(df)}
+        return analytics
+
+def slice_time_window(df, start=None, end=None, inclusive='left'):
+    """
+    Returns the rows of df within a time window, found by binary search on its sorted DatetimeIndex.
+    The result is a slice of df, not a copy, so do not modify it.
+
+    start, end: bounds of the window, None for no bound
+    inclusive: which bounds are included, 'left' (default, start <= t < end), 'right', 'both' or 'neither'
+    """
+    first = 0 if start is None else df.index.searchsorted(start, side='left' if inclusive in ('left', 'both') else 'right')
+    last = len(df) if end is None else df.index.searchsorted(end, side='right' if inclusive in ('right', 'both') else 'left')
+    return df.iloc[first:max(first, last)]
+
+def get_sums(freq, recurring_only=False):
+    """
+    Returns Sum_confirmed summed per day (freq='D') or month (freq='M') as a Series indexed by the day/last
+    day of the month, and the version of the sums. With recurring_only only donors with more than one
+    donation are included.
+    """
+    df, version = dbi.get_versioned_aggregate('Donations', 'Sum_confirmed', freq, recurring_only=recurring_only)
+    return df.set_index('Timestamp_confirmed')['Sum_confirmed'], version
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+# Generated figures, cached as their JSON so that a hit skips building and validating the figure. Dash still
+# encodes the returned dict for every response, so a hit does not skip serializing it.
+# Each process keeps the most recently used figures within FIGURE_CACHE_MEMORY_BUDGET bytes. If
+# FIGURE_CACHE_DIR is set, figures are also stored there, shared by all worker processes, and the least
+# recently used files are removed when they take more than FIGURE_CACHE_DISK_BUDGET bytes.
+FIGURE_CACHE_MEMORY_BUDGET = int(os.getenv('FIGURE_CACHE_MEMORY_BUDGET', 64 * 1024**2))
+FIGURE_CACHE_DIR = os.getenv('FIGURE_CACHE_DIR')
+FIGURE_CACHE_DISK_BUDGET = int(os.getenv('FIGURE_CACHE_DISK_BUDGET', 256 * 1024**2))
+
+figures = OrderedDict() # Key to figure JSON, least recently used first
+lock = Lock()
+
+def make_key(build, args, kwargs, version):
+    # The same in all processes, so that it can name the file of the figure
+    name = f"{build.__module__}.{build.__qualname__}"
+    return hashlib.sha1(repr((name, args, sorted(kwargs.items()), version)).encode()).hexdigest()
+
+def get_memory(key):
+    with lock:
+        if key not in figures:
+            return None
+        figures.move_to_end(key)
+        return figures[key]
+
+def put_memory(key, figure_json):
+    with lock:
+        figures[key] = figure_json
+        figures.move_to_end(key)
+        footprint = sum(len(figure) for figure in figures.values())
+        for old_key in list(figures):
+            if footprint <= FIGURE_CACHE_MEMORY_BUDGET or old_key == key:
+                break
+            footprint -= len(figures.pop(old_key))
+
+def figure_path(key):
+    return os.path.join(FIGURE_CACHE_DIR, f"{key}.json")
+
+def get_disk(key):
+    try:
+        with open(figure_path(key)) as f:
+            figure_json = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(figure_path(key)) # Marks it as recently used
+    except FileNotFoundError:
+        pass # Evicted by another process since we read it
+    return figure_json
+
+def put_disk(key, figure_json):
+    os.makedirs(FIGURE_CACHE_DIR, exist_ok=True)
+    # Written to a temporary file first, so that other processes never read a partial figure
+    fd, tmp_path = tempfile.mkstemp(dir=FIGURE_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(figure_json)
+        os.replace(tmp_path, figure_path(key))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    evict_disk()
+
+def evict_disk():
+    files = []
+    for entry in os.scandir(FIGURE_CACHE_DIR):
+        if entry.name.endswith('.json'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue # Removed by another process
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    footprint = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files)[:-1]: # Least recently used first, never the newest
+        if footprint <= FIGURE_CACHE_DISK_BUDGET:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        footprint -= size
+
+def get_figure(build, *args, version=None, **kwargs):
+    """
+    Returns the figure build(*args, **kwargs) as a dict, like the JSON Dash sends to the browser, which Dash
+    encodes again for each response.
+    The figure is built once per combination of build, arguments and version, so version must change
+    whenever the data the figure is built from does, e.g. the version of the cached data.
+    """
+    key = make_key(build, args, kwargs, version)
+    figure_json = get_memory(key)
+    if figure_json is None and FIGURE_CACHE_DIR is not None:
+        figure_json = get_disk(key)
+        if figure_json is not None:
+            put_memory(key, figure_json)
+    if figure_json is None:
+        figure_json = build(*args, **kwargs).to_json()
+        put_memory(key, figure_json)
+        if FIGURE_CACHE_DIR is not None:
+            put_disk(key, figure_json)
+    return json.loads(figure_json)
+
+def clear():
+    """Removes all cached figures of this process, and the shared ones on disk"""
+    with lock:
+        figures.clear()
+    if FIGURE_CACHE_DIR is not None and os.path.isdir(FIGURE_CACHE_DIR):
+        for entry in os.scandir(FIGURE_CACHE_DIR):
+            if entry.name.endswith('.json'):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
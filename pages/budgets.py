@@ -3,6 +3,7 @@ import dash
 import dash_bootstrap_components as dbc
 import numpy as np
 import plotting.budgets_plot as plot
+import figure_cache
 
 dash.register_page(__name__)
 
@@ -10,7 +11,7 @@ year_range = (2016,2022)
 
 graph = dcc.Graph(
     id='budget-graph', 
-    figure=plot.plot_sankey(year=year_range[0]),
+    figure=figure_cache.get_figure(plot.plot_sankey, year_range[0]),
     config={'displayModeBar': False},
     clear_on_unhover=True,
     style={"width": "100%", "max-width":"1000px"},
@@ -49,4 +50,4 @@ layout = html.Div(
 def update_graph(year):
     if year==None:
         return no_update
-    return plot.plot_sankey(int(year))
+    return figure_cache.get_figure(plot.plot_sankey, int(year))
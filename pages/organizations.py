@@ -1,6 +1,7 @@
 from dash import Dash, html, dcc, Output, Input, no_update, callback
 import dash_bootstrap_components as dbc
 import plotting.organizations_plot as pl
+import figure_cache
 import numpy as np
 import dash
 
@@ -16,20 +17,21 @@ org_descriptions = {
     'NI': dict(descr='Vaksinerer spedbarn i Nigeria.', link='https://www.newincentives.org/')
 }
 
-graph = dcc.Graph(
-    id='yearly-donations-graph', 
-    figure=pl.get_plot(),
-    config={'displayModeBar': False},
-    clear_on_unhover=True,
-    style={"width": "100%", "max-width":"1000px"},
-)
+def layout():
+    graph = dcc.Graph(
+        id='yearly-donations-graph', 
+        figure=figure_cache.get_figure(pl.get_plot, version=pl.get_data()['version']),
+        config={'displayModeBar': False},
+        clear_on_unhover=True,
+        style={"width": "100%", "max-width":"1000px"},
+    )
 
-layout = html.Div(
-    dbc.Container([
-        dbc.Row(dbc.Col(graph)),
-        dcc.Tooltip(id='graph-tooltip', direction='right', show=False, style={'backgroundColor':'#fafafa'}),
-    ]), style={'margin': '50px 0px 0px', "width": "100%", "max-width":"1000px",}
-)
+    return html.Div(
+        dbc.Container([
+            dbc.Row(dbc.Col(graph)),
+            dcc.Tooltip(id='graph-tooltip', direction='right', show=False, style={'backgroundColor':'#fafafa'}),
+        ]), style={'margin': '50px 0px 0px', "width": "100%", "max-width":"1000px",}
+    )
 
 @callback(
     Output("graph-tooltip", "show"),
@@ -50,8 +52,9 @@ def display_hover(hoverData):
     if not image_trace and (not time_trace if pl.tooltip else True):
         return False, no_update, no_update
     
+    data = pl.get_data()
     org_id = int(np.floor((trace_number-3)/7))
-    org_name = pl.sorted_orgs[org_id]
+    org_name = data['sorted_orgs'][org_id]
     org_full_name = pl.abbriv2fullname_dict[org_name]
     bbox = point["bbox"]
    
@@ -60,8 +63,8 @@ def display_hover(hoverData):
     else:
         point_number = point['pointNumber']
         org_text = f'''
-        Dato: {pl.days_by_org[org_id][point_number].strftime("%d-%m-%Y")} \n
-        Mengde: {np.cumsum(pl.donations_by_org[org_id])[point_number]:,.0f} kr'''
+        Dato: {data['days_by_org'][org_id][point_number].strftime("%d-%m-%Y")} \n
+        Mengde: {np.cumsum(data['donations_by_org'][org_id])[point_number]:,.0f} kr'''
     
     children = [
         html.Div(
@@ -1,62 +1,189 @@
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import database_import as dbi
-
-df = dbi.get_df(table_name='Donations')
-df = df.sort_values(by='Timestamp_confirmed')
-df.index = pd.to_datetime(df['Timestamp_confirmed'])
-
-# Filter out recurring donations
-ID_num_count = df['Donor_ID'].value_counts()
-recurring_IDs = [ind for ind,val in zip(ID_num_count.index, ID_num_count.values) if val>1]
-df_recurring = df.loc[df['Donor_ID'].isin(recurring_IDs)]
-
-#Get monthly donations for all, and recurring donations
-MDs = pd.DataFrame() #monthly donations
-MDs['Sum_confirmed'] = df['Sum_confirmed'].resample('M').sum() #Resample by day
-MDs['date_name'] = [ts.month_name()[:3] + ' ' + str(ts.year) for ts in MDs.index]
-MDs['timestamp'] = MDs.index
-MDs.index = [i for i in range(0,len(MDs))]
-
-MDs_recurring = pd.DataFrame() #monthly donations
-MDs_recurring['Sum_confirmed'] = df_recurring['Sum_confirmed'].resample('M').sum() #Resample by day
-MDs_recurring['date_name'] = [ts.month_name()[:3] + ' ' + str(ts.year) for ts in MDs_recurring.index]
-MDs_recurring['timestamp'] = MDs_recurring.index
-MDs_recurring.index = [i for i in range(0,len(MDs_recurring))]
+import donations_analytics as da
+from threading import Lock
+
+def month_df(monthly_sums):
+    MDs = pd.DataFrame() #monthly donations
+    MDs['Sum_confirmed'] = monthly_sums
+    MDs['date_name'] = [ts.month_name()[:3] + ' ' + str(ts.year) for ts in MDs.index]
+    MDs['timestamp'] = MDs.index
+    MDs.index = [i for i in range(0,len(MDs))]
+    return MDs
+
+LOG_BINS = 50 # Number of log-spaced bins of the histogram index
+LINEAR_BINS = 50 # About how many equal bins the linear histogram has
+BAR_GAP = 0.05 # Share of each bin left empty between the bars
+
+def log_bin_edges(amounts, n_bins=LOG_BINS):
+    # Log-spaced bin edges from the smallest to the largest positive amount
+    amounts = amounts[amounts > 0]
+    if len(amounts) == 0:
+        return np.logspace(0, 1, n_bins + 1)
+    return np.logspace(np.log10(amounts.min()), np.log10(amounts.max()), n_bins + 1)
+
+def month_numbers(df, months):
+    # The index of the month of each donation in months, the month end timestamps of the slider
+    return ((df.index.year - months[0].year) * 12 + (df.index.month - months[0].month)).to_numpy()
+
+def monthly_max(df, months):
+    # The largest Sum_confirmed of each month, NaN for months without donations
+    month = month_numbers(df, months)
+    valid = (month >= 0) & (month < len(months))
+    maxima = np.full(len(months), -np.inf)
+    np.maximum.at(maxima, month[valid], df['Sum_confirmed'].to_numpy()[valid])
+    return np.where(np.isinf(maxima), np.nan, maxima)
+
+def histogram_index(df, months, edges):
+    """
+    Returns the cumulative monthly histogram of the Sum_confirmed of df, a (len(months) + 1) x (len(edges) - 1)
+    matrix whose row i holds the number of donations in each bin before month i. The counts of months a to b
+    (inclusive) are index[b + 1] - index[a], so a slider window costs one subtraction regardless of the
+    number of donations.
+
+    df: donations with a DatetimeIndex
+    months: the month end timestamps of the slider, the first month is index 0
+    """
+    n_months, n_bins = len(months), len(edges) - 1
+    amounts = df['Sum_confirmed'].to_numpy()
+    month = month_numbers(df, months)
+    # Like np.histogram, the last bin includes its right edge
+    bin = np.clip(np.searchsorted(edges, amounts, side='right') - 1, 0, n_bins - 1)
+    # Donations outside the months, when the donations were refreshed after the monthly sums, are left out
+    valid = (month >= 0) & (month < n_months) & (amounts >= edges[0])
+    counts = np.bincount(month[valid] * n_bins + bin[valid], minlength=n_months * n_bins).reshape(n_months, n_bins)
+
+    index = np.zeros((n_months + 1, n_bins), dtype=np.int64)
+    np.cumsum(counts, axis=0, out=index[1:])
+    return index
+
+def linear_indexes(df, months, maxima, n_bins=LINEAR_BINS):
+    """
+    Returns a histogram index (see histogram_index) for every bin size the linear histogram of a window can
+    have, as a dict from bin size to index. The largest donation of a window is the largest of one of its
+    months, so the bin size is linear_bin_size of one of maxima, and there are at most n_bins + 1 bins from 0.
+    """
+    sizes = {linear_bin_size(max_amount, n_bins) for max_amount in maxima[~np.isnan(maxima)]}
+    return {size: histogram_index(df, months, np.arange(n_bins + 2) * size) for size in sizes}
+
+def prepare_data(analytics, monthly_sums, monthly_sums_recurring):
+    #Get monthly donations for all, and recurring donations
+    MDs = month_df(monthly_sums)
+    edges = log_bin_edges(analytics['df']['Sum_confirmed'].to_numpy())
+    # All indexes use the months of the slider, which are those of all donations
+    months = list(MDs['timestamp'])
+    maxima = monthly_max(analytics['df'], months)
+    maxima_recurring = monthly_max(analytics['df_recurring'], months)
+    return {
+        'df': analytics['df'],
+        'df_recurring': analytics['df_recurring'],
+        'MDs': MDs,
+        'MDs_recurring': month_df(monthly_sums_recurring),
+        'edges': edges,
+        'index': histogram_index(analytics['df'], months, edges),
+        'index_recurring': histogram_index(analytics['df_recurring'], months, edges),
+        'maxima': maxima,
+        'maxima_recurring': maxima_recurring,
+        'linear_index': linear_indexes(analytics['df'], months, maxima),
+        'linear_index_recurring': linear_indexes(analytics['df_recurring'], months, maxima_recurring),
+    }
+
+data = None
+lock = Lock() # Threads wait for the data to be prepared once, instead of all preparing it
+
+def get_data():
+    # Computed on first use, and again whenever the cached donations change
+    global data
+    analytics = da.get_analytics()
+    monthly_sums, monthly_version = da.get_sums('M')
+    monthly_sums_recurring, monthly_recurring_version = da.get_sums('M', recurring_only=True)
+    version = (analytics['version'], monthly_version, monthly_recurring_version)
+    with lock:
+        if data is None or data['version'] != version:
+            data = {'version': version, **prepare_data(analytics, monthly_sums, monthly_sums_recurring)}
+        return data
+
+def get_month_marks():
+    return {i: ts.month_name()[:3] + ' ' + str(ts.year) for i,ts in enumerate(get_data()['MDs']['timestamp'])}
 
 def get_df_subset_by_month(month_index_range, month_df, full_df):
-    all_dates = month_df.iloc[month_index_range[0]:month_index_range[1]]
-    date_1 = all_dates['timestamp'].iloc[0]
-    date_2 = all_dates['timestamp'].iloc[-1]
-    df_subset = full_df.loc[(full_df.index>date_1)&(full_df.index<date_2)]
-    return df_subset
-
-def get_histogram(month_index_range, exclude_otd, n_bins=50):
-    month_df = MDs_recurring if exclude_otd else MDs
-    full_df = df_recurring if exclude_otd else df
-    df_subset = get_df_subset_by_month(month_index_range, month_df=month_df, full_df=full_df)
-    donations = df_subset['Sum_confirmed'].to_numpy()
+    # Donations from the first day of the first month to the last day of the last month (inclusive)
+    first_month, last_month = month_index_range
+    start = month_df['timestamp'].iloc[first_month].to_period('M').start_time
+    end = month_df['timestamp'].iloc[last_month].to_period('M').end_time
+    return da.slice_time_window(full_df, start, end, inclusive='both')
+
+def get_window_counts(month_index_range, exclude_otd):
+    """Returns the number of donations in each bin in the months of month_index_range (inclusive), and the bin edges"""
+    data = get_data()
+    index = data['index_recurring'] if exclude_otd else data['index']
+    first_month, last_month = month_index_range
+    return index[last_month + 1] - index[first_month], data['edges']
+
+def linear_bin_size(max_amount, n_bins):
+    # Smallest round bin size (1, 2, 2.5 or 5 times a power of 10) that fits max_amount in n_bins bins, like plotly's autobinning
+    if max_amount <= 0:
+        return 1.0
+    raw_size = max_amount / n_bins
+    magnitude = 10 ** np.floor(np.log10(raw_size))
+    return next(m * magnitude for m in [1, 2, 2.5, 5, 10] if m * magnitude >= raw_size)
+
+def get_linear_window_counts(month_index_range, exclude_otd, n_bins=LINEAR_BINS):
+    """
+    Returns the number of donations in each of about n_bins bins from 0 in the months of month_index_range, and the bin edges.
+    With the default n_bins the counts are looked up in the linear histogram indexes, otherwise the donations of the window are binned.
+    """
+    data = get_data()
+    first_month, last_month = month_index_range
+    maxima = data['maxima_recurring'] if exclude_otd else data['maxima']
+    window_maxima = maxima[first_month:last_month + 1]
+    if np.isnan(window_maxima).all():
+        return np.zeros(1, dtype=np.int64), np.array([0.0, 1.0])
+    max_amount = np.nanmax(window_maxima)
+    size = linear_bin_size(max_amount, n_bins)
+    edges = np.arange(int(max_amount // size) + 2) * size
+
+    if n_bins == LINEAR_BINS:
+        index = (data['linear_index_recurring'] if exclude_otd else data['linear_index'])[size]
+        return (index[last_month + 1] - index[first_month])[:len(edges) - 1], edges
+    full_df = data['df_recurring'] if exclude_otd else data['df']
+    donations = get_df_subset_by_month(month_index_range, month_df=data['MDs'], full_df=full_df)['Sum_confirmed'].to_numpy()
+    counts, edges = np.histogram(donations, bins=edges)
+    return counts, edges
+
+def get_histogram(month_index_range, exclude_otd, log_x=False, n_bins=LINEAR_BINS):
+    """
+    Returns the histogram of the donations in the months of month_index_range. The donations are binned here,
+    so only the counts are sent to the browser. By default there are about n_bins bins of equal size from 0,
+    with log_x the log-spaced bins of the histogram index are shown on a log x axis. Both are looked up in
+    precomputed indexes, so the cost does not depend on the number of donations in the window.
+    """
+    if log_x:
+        counts, edges = get_window_counts(month_index_range, exclude_otd)
+    else:
+        counts, edges = get_linear_window_counts(month_index_range, exclude_otd, n_bins)
+    widths = np.diff(edges)
     fig = go.Figure()
     fig.add_trace(
-        go.Histogram(
-            x = donations, 
-            nbinsx = n_bins, 
-            #xbins = dict(start=0, end=max(donations)*1.02, size=max(donations)/50),
-            xbins = dict(start=0),
-            autobinx=False,
-            marker_color = 'black', 
-            hovertemplate = '<b>Donasjonsmenge:</b> %{x} NOK<br><b>Antall:</b> %{y:.0f}<extra></extra>', 
-            histnorm = ''
+        go.Bar(
+            # Bars are drawn from the left edge of their bin, with a gap between them like a histogram's bargap
+            x = edges[:-1],
+            y = counts,
+            width = widths * (1 - BAR_GAP),
+            offset = widths * BAR_GAP / 2,
+            customdata = np.column_stack([edges[:-1], edges[1:]]),
+            marker_color = 'black',
+            hovertemplate = '<b>Donasjonsmenge:</b> %{customdata[0]:,.0f} - %{customdata[1]:,.0f} NOK<br><b>Antall:</b> %{y:.0f}<extra></extra>',
     ))
     
-    upper_range = int(np.ceil(np.log10(len(donations)))) #Highest power of 10
+    upper_range = int(np.ceil(np.log10(max(counts.sum(), 1)))) #Highest power of 10
     major_ticks = np.logspace(0,upper_range,upper_range+1)
     all_ticks = np.outer(major_ticks,np.arange(1,10,1)).flatten()
         
     [fig.add_hline(y=hlv, line_color='#fafafa', line_width=0.5) for hlv in major_ticks]
     fig.update_layout(
-        xaxis = dict(title=dict(text='Donasjonsmenge [NOK]'), fixedrange=True),
+        xaxis = dict(type='log' if log_x else 'linear', title=dict(text='Donasjonsmenge [NOK]'), fixedrange=True),
         yaxis = dict(
             type='log',
             title=dict(text='Antall donasjoner'),
@@ -71,7 +198,6 @@ def get_histogram(month_index_range, exclude_otd, n_bins=50):
         plot_bgcolor='rgba(0,0,0,0)',
         font_family="ESKlarheit",
         margin=dict(l=0, r=0, t=0, b=0),
-        bargap=0.05
     )
     return fig
 
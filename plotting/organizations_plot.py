@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 import database_import as dbi
 from datetime import timedelta, datetime
+from threading import Lock
 
 tooltip = False
 include_givewell = True
@@ -65,7 +66,8 @@ def add_name_trace(fig, org, row, col=2):
     fig.update_xaxes(range=[0,1],row=row, col=col)
     return fig
 
-def add_donation_trace(fig, org, row, col=3):
+def add_donation_trace(fig, data, org, row, col=3):
+    df, df_year = data['df'], data['df_year']
     dates = df.loc[df['Org']==org,'day'].to_numpy()
     donations = df.loc[df['Org']==org,'Amount'].to_numpy()
     # Sparkline column
@@ -95,7 +97,7 @@ def add_donation_trace(fig, org, row, col=3):
                 ), row=row, col=col
             
             )
-        fig.update_xaxes(range=[min_date,max_date],row=row, col=col) #Use instead of share_xaxes because that hides traces for some reason
+        fig.update_xaxes(range=[data['min_date'],data['max_date']],row=row, col=col) #Use instead of share_xaxes because that hides traces for some reason
     else:
         org_df = df_year.loc[df_year['Org']==org]
         fig.add_trace( #Trace 6n+6
@@ -118,7 +120,8 @@ def add_donation_trace(fig, org, row, col=3):
         fig.update_yaxes(range=[0,1.5*max(org_df['Amount'])],row=row, col=col)
     return fig
 
-def add_histogram_trace(fig, org, row, col=4):
+def add_histogram_trace(fig, data, org, row, col=4):
+    df, max_total_donation = data['df'], data['max_total_donation']
     donations = df.loc[df['Org']==org,'Amount'].to_numpy()
     fig.add_trace(
             go.Scatter(
@@ -142,50 +145,77 @@ def add_histogram_trace(fig, org, row, col=4):
     fig.update_yaxes(range=[-1.1,1.1],row=row, col=col)
     return fig
 
-#df = pd.read_csv('summary.csv')
-#df = dbi.get_df()
-df = dbi.get_df(table_name='Scorecard_Organization_donations')
-df.index = pd.to_datetime(df['Timestamp']).dt.date
-df['day'] = df.index
-df = df.sort_values(by='day')
-df['year'] = df['Timestamp'].dt.year
-df_year = df.groupby(['year', 'Org'])['Amount'].sum().reset_index()
-
 df_fullnames = pd.read_csv('organizations.csv')#, encoding='latin1')
 #df_fullnames = dbi.org_df
 abbriv2fullname_dict = {abbriv: fullname for abbriv, fullname in zip(df_fullnames['abbriv'],df_fullnames['full_name'])}
 
-all_unique_org_names = df['Org'].unique()
-
-unique_org_names = all_unique_org_names if include_givewell else all_unique_org_names[(all_unique_org_names!='GiveWell')]
-total_sums = [df.loc[df['Org']==orgName]['Amount'].sum() for orgName in unique_org_names]
-sorted_index = np.argsort(total_sums)
-
-#sorted_orgs = unique_org_names[sorted_index]
-sorted_orgs = unique_org_names[sorted_index][len(all_unique_org_names)-include_number:]
-# days_by_org = [ df.loc[df['Org']==org,'day'].to_numpy() for org in sorted_orgs]
-# donations_by_org = [ df.loc[df['Org']==org,'Amount'].to_numpy() for org in sorted_orgs]
-days_by_org = [ df.loc[df['Org']==org,'day'].to_numpy() for org in sorted_orgs]
-donations_by_org = [ df.loc[df['Org']==org,'Amount'].to_numpy() for org in sorted_orgs]
-
-#nonLumpOrgNum = 3 #Number of which not to lump into "others category"
-#orgs_with_most = sorted_orgs[len(sorted_orgs)-nonLumpOrgNum:] #nonLumpOrgNum largest organizations
-#df['LumpedOrg'] = df.apply(lambda row: row['Org'] if row['Org'] in orgs_with_most else 'Others', axis=1) #Lump organizations
-#lumped_org_names = np.append(orgs_with_most,'Others')
-# days_by_org_lumped = [ df.loc[df['LumpedOrg']==org,'day'].to_numpy() for org in lumped_org_names]
-# donations_by_org_lumped = [ df.loc[df['LumpedOrg']==org,'Amount'].to_numpy() for org in lumped_org_names]
-
-### Plotting ###
-min_date = min([days[0] for days in days_by_org])-timedelta(days=1)
-max_date = max([days[-1] for days in days_by_org])+timedelta(days=1)
-tick_years = [y for y in range(min_date.year, max_date.year+1)]
-max_total_donation = sum(donations_by_org[-1])
-rows = len(sorted_orgs) + 1
+def prepare_data(df):
+    #df = pd.read_csv('summary.csv')
+    #df = dbi.get_df()
+    df = df.copy() # The cached frame is shared, so work on a copy
+    df.index = pd.to_datetime(df['Timestamp']).dt.date
+    df['day'] = df.index
+    df = df.sort_values(by='day')
+    df['year'] = df['Timestamp'].dt.year
+    df_year = df.groupby(['year', 'Org'])['Amount'].sum().reset_index()
+
+    all_unique_org_names = df['Org'].unique()
+
+    unique_org_names = all_unique_org_names if include_givewell else all_unique_org_names[(all_unique_org_names!='GiveWell')]
+    total_sums = [df.loc[df['Org']==orgName]['Amount'].sum() for orgName in unique_org_names]
+    sorted_index = np.argsort(total_sums)
+
+    #sorted_orgs = unique_org_names[sorted_index]
+    sorted_orgs = unique_org_names[sorted_index][len(all_unique_org_names)-include_number:]
+    # days_by_org = [ df.loc[df['Org']==org,'day'].to_numpy() for org in sorted_orgs]
+    # donations_by_org = [ df.loc[df['Org']==org,'Amount'].to_numpy() for org in sorted_orgs]
+    days_by_org = [ df.loc[df['Org']==org,'day'].to_numpy() for org in sorted_orgs]
+    donations_by_org = [ df.loc[df['Org']==org,'Amount'].to_numpy() for org in sorted_orgs]
+
+    #nonLumpOrgNum = 3 #Number of which not to lump into "others category"
+    #orgs_with_most = sorted_orgs[len(sorted_orgs)-nonLumpOrgNum:] #nonLumpOrgNum largest organizations
+    #df['LumpedOrg'] = df.apply(lambda row: row['Org'] if row['Org'] in orgs_with_most else 'Others', axis=1) #Lump organizations
+    #lumped_org_names = np.append(orgs_with_most,'Others')
+    # days_by_org_lumped = [ df.loc[df['LumpedOrg']==org,'day'].to_numpy() for org in lumped_org_names]
+    # donations_by_org_lumped = [ df.loc[df['LumpedOrg']==org,'Amount'].to_numpy() for org in lumped_org_names]
+
+    ### Plotting ###
+    min_date = min([days[0] for days in days_by_org])-timedelta(days=1)
+    max_date = max([days[-1] for days in days_by_org])+timedelta(days=1)
+    max_total_donation = sum(donations_by_org[-1])
+    rows = len(sorted_orgs) + 1
+
+    return {
+        'df': df,
+        'df_year': df_year,
+        'sorted_orgs': sorted_orgs,
+        'days_by_org': days_by_org,
+        'donations_by_org': donations_by_org,
+        'min_date': min_date,
+        'max_date': max_date,
+        'max_total_donation': max_total_donation,
+        'rows': rows,
+    }
+
+data = None
+lock = Lock() # Threads wait for the data to be prepared once, instead of all preparing it
+
+def get_data():
+    # Computed on first use, and again whenever the cached donations change
+    global data
+    df, version = dbi.get_versioned_df(table_name='Scorecard_Organization_donations', columns=dbi.SCORECARD_COLUMNS, dtypes=dbi.SCORECARD_DTYPES)
+    with lock:
+        if data is None or data['version'] != version:
+            data = {'version': version, **prepare_data(df)}
+        return data
+
 #width_ratios = [0.5, 2, 3, 3]
 #gs_kw = {'width_ratios': width_ratios, 'wspace':0, 'hspace':0, 'top':1, 'bottom':0, 'left':0, 'right':0}
 vert_spacing = 0.0
 
 def get_plot():
+    data = get_data()
+    rows = data['rows']
     fig = sp.make_subplots(rows=rows, cols=4, 
                            #shared_xaxes='columns', 
                            column_widths=[0.5, 1.0, 1.5, 1.5],
@@ -203,13 +233,13 @@ def get_plot():
     fig.update_xaxes(range=[0,1],row=1, col=4) #In order to align text to left
     fig.add_shape(go.layout.Shape(x0=0, x1=1, y0=1-(1/(rows)), y1=1-(1/(rows)), xref='paper', yref='paper', line=dict(width=1.5)))
     
-    for i, org in enumerate(sorted_orgs): #All organizations
+    for i, org in enumerate(data['sorted_orgs']): #All organizations
         row = rows-i
 
         fig = add_image_trace(fig, org=org, row=row, col=1)
         fig = add_name_trace(fig, org=org, row=row, col=2)
-        fig = add_donation_trace(fig, org=org, row=row, col=3)
-        fig = add_histogram_trace(fig, org=org, row=row, col=4)
+        fig = add_donation_trace(fig, data, org=org, row=row, col=3)
+        fig = add_histogram_trace(fig, data, org=org, row=row, col=4)
 
         #fig.add_shape(go.layout.Shape(x0=0, x1=1, y0=1-(j*(1+vert_spacing)/rows), y1=1-(j*(1+vert_spacing)/rows), xref='paper', yref='paper', line=dict(width=0.5)))
         # line = plt.Line2D((0,1),((i+1)/(rows), (i+1)/(rows)), color="grey", linewidth=2.0 if j==1 else 0.5, transform=fig.transFigure)
@@ -2,7 +2,8 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
-import database_import as dbi
+import donations_analytics as da
+from threading import Lock
 
 pd.set_option("display.precision", 0)
 
@@ -10,35 +11,39 @@ def fixLeapYear(dates,donations):
     isNotLeapYearDate = ~(dates=='02-29')
     return dates[isNotLeapYearDate],donations[isNotLeapYearDate]
 
-# df = pd.read_csv('donations-effekt.csv', parse_dates=['Timestamp_confirmed'])
-# df = df.sort_values(by='Timestamp_confirmed')
-df = dbi.get_df(table_name='Donations')
-# df = dbi.ds_corr.sort_values(by='Timestamp_confirmed')
-df = df.sort_values(by='Timestamp_confirmed')
-df.index = pd.to_datetime(df['Timestamp_confirmed'])
+def prepare_data(daily_sums):
+    # Get yearly donations and sort by year
+    DDs = pd.DataFrame() #daily donations
+    DDs['value'] = daily_sums
+    DDs['y-m-d'] = pd.to_datetime(DDs.index)
+    DDs['y']= DDs['y-m-d'].dt.strftime('%Y')
+    DDs['m-d'] = DDs['y-m-d'].dt.strftime('%m') + "-" + DDs['y-m-d'].dt.strftime('%d')
 
-# Filter out recurring donations
-ID_num_count = df['Donor_ID'].value_counts()
-recurring_IDs = [ind for ind,val in zip(ID_num_count.index, ID_num_count.values) if val>1]
-df_reccuring = df.loc[df['Donor_ID'].isin(recurring_IDs)]
+    year_strings = [str(yr) for yr in range(2018,int(DDs['y'][-1])+1)]
+    dates_by_year     = [ DDs.loc[DDs['y']==year_str,'m-d'].to_numpy() for year_str in year_strings]
+    donations_by_year = [ DDs.loc[DDs['y']==year_str,'value'].to_numpy() for year_str in year_strings]
+    dates_by_year,donations_by_year = zip(*[ fixLeapYear(dts,dons) for dts,dons in zip(dates_by_year,donations_by_year) ])
 
-# Get yearly donations and sort by year
-DDs = pd.DataFrame() #daily donations
-DDs['value'] = df['Sum_confirmed'].resample('D').sum() #Resample by day
-DDs['y-m-d'] = pd.to_datetime(DDs.index)
-DDs['y']= DDs['y-m-d'].dt.strftime('%Y')
-DDs['m-d'] = DDs['y-m-d'].dt.strftime('%m') + "-" + DDs['y-m-d'].dt.strftime('%d')
+    return {'year_strings': year_strings, 'dates_by_year': dates_by_year, 'donations_by_year': donations_by_year}
 
-year_strings = [str(yr) for yr in range(2018,int(DDs['y'][-1])+1)]
-dates_by_year     = [ DDs.loc[DDs['y']==year_str,'m-d'].to_numpy() for year_str in year_strings]
-donations_by_year = [ DDs.loc[DDs['y']==year_str,'value'].to_numpy() for year_str in year_strings]
-dates_by_year,donations_by_year = zip(*[ fixLeapYear(dts,dons) for dts,dons in zip(dates_by_year,donations_by_year) ])
+data = None
+lock = Lock() # Threads wait for the data to be prepared once, instead of all preparing it
 
-yMax = max([sum(dons) for dons in donations_by_year])
+def get_data():
+    # Computed on first use, and again whenever the cached donations change
+    global data
+    daily_sums, version = da.get_sums('D')
+    with lock:
+        if data is None or data['version'] != version:
+            data = {'version': version, **prepare_data(daily_sums)}
+        return data
 
 yearly_dons_hovertemplate = '<b>Dato:</b> %{x}<br><b>Verdi:</b> %{y:,.0f} kr'
 
 def get_yearly_donations_plot():
+    data = get_data()
+    year_strings = data['year_strings']
+    dates_by_year, donations_by_year = data['dates_by_year'], data['donations_by_year']
     fig = go.Figure()
     for dates, dons, year_str in zip(dates_by_year, donations_by_year, year_strings):
         dates = ['1970-'+d for d in dates]
@@ -0,0 +1,202 @@
+import pyarrow as pa
+import os
+import json
+import fcntl
+import glob
+import hashlib
+import tempfile
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+# Snapshots of the cached tables on local disk, shared by all worker processes of the server.
+# A snapshot is an Arrow IPC file with the data, named by its version, and a JSON file with the current
+# version and the time it was fetched. Workers memory map the Arrow file read-only, so the operating system
+# keeps a single copy of the data in memory no matter how many workers there are.
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'dash-snapshots'))
+# Bytes of snapshot data kept in SNAPSHOT_DIR. On Cloud Run it is in memory, so the least recently used
+# snapshots are removed when they take more than this.
+SNAPSHOT_DISK_BUDGET = int(os.getenv('SNAPSHOT_DISK_BUDGET', 1024**3))
+
+def snapshot_name(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+def meta_path(key):
+    return os.path.join(SNAPSHOT_DIR, f"{snapshot_name(key)}.json")
+
+def data_path(key, version):
+    return os.path.join(SNAPSHOT_DIR, f"{snapshot_name(key)}-{version}.arrow")
+
+def read_meta(key):
+    """
+    Returns the metadata of the snapshot of key, a dict with version, timestamp and full_timestamp,
+    or None if there is no snapshot
+    """
+    try:
+        with open(meta_path(key)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    meta['timestamp'] = datetime.fromisoformat(meta['timestamp'])
+    meta['full_timestamp'] = datetime.fromisoformat(meta['full_timestamp'])
+    return meta
+
+def read_data(key, version):
+    """
+    Returns the data of the given snapshot version as a DataFrame backed by a read-only memory map,
+    or None if that version has been removed
+    """
+    try:
+        source = pa.memory_map(data_path(key, version), 'r')
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(data_path(key, version)) # Marks it as recently used
+    except FileNotFoundError:
+        pass
+    table = pa.ipc.open_file(source).read_all()
+    # One block per column lets numeric columns point straight into the memory map instead of being copied
+    return table.to_pandas(split_blocks=True)
+
+def write_snapshot(key, table_name, meta, df=None):
+    """
+    Makes meta the current metadata of the snapshot of key. If df is given it is stored as the data of a new
+    version, which is returned. Without df meta['version'] must be an existing version, and only its
+    timestamps are updated.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    meta = dict(meta)
+    if df is not None:
+        meta['version'] = uuid.uuid4().hex
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        write_atomic(data_path(key, meta['version']), lambda sink: write_table(sink, table))
+
+    meta_json = json.dumps({
+        'table_name': table_name,
+        'version': meta['version'],
+        'timestamp': meta['timestamp'].isoformat(),
+        'full_timestamp': meta['full_timestamp'].isoformat(),
+    })
+    write_atomic(meta_path(key), lambda sink: sink.write(meta_json.encode()))
+
+    if df is not None:
+        remove_old_versions(key, keep=meta['version'])
+        evict_snapshots(keep=key)
+    else:
+        try:
+            os.utime(data_path(key, meta['version'])) # Still in use
+        except FileNotFoundError:
+            pass
+    return meta['version']
+
+def write_table(sink, table):
+    # Uncompressed, so that the file can be memory mapped without decoding
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+def write_atomic(path, write):
+    # Readers only ever see complete files
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def remove_old_versions(key, keep):
+    # Processes that have already mapped a removed file keep reading it until they load the new version
+    for path in glob.glob(os.path.join(SNAPSHOT_DIR, f"{snapshot_name(key)}-*.arrow")):
+        if path != data_path(key, keep):
+            os.remove(path)
+
+def remove_snapshot_files(name):
+    # The metadata first, so that no process finds a snapshot whose data has been removed
+    for path in [os.path.join(SNAPSHOT_DIR, f"{name}.json")] + glob.glob(os.path.join(SNAPSHOT_DIR, f"{name}-*.arrow")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # Removed by another process
+
+def remove_snapshots(table_name=None):
+    """Removes the snapshots of table_name, or all snapshots if table_name is None, with their data"""
+    for path in glob.glob(os.path.join(SNAPSHOT_DIR, '*.json')):
+        try:
+            with open(path) as f:
+                snapshot_table = json.load(f)['table_name']
+        except FileNotFoundError:
+            continue # Removed by another process
+        if table_name is None or snapshot_table == table_name:
+            remove_snapshot_files(os.path.basename(path)[:-len('.json')])
+    if table_name is None:
+        # Data left behind without metadata
+        for path in glob.glob(os.path.join(SNAPSHOT_DIR, '*.arrow')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def evict_snapshots(keep):
+    """
+    Removes the least recently used snapshots while their data takes more than SNAPSHOT_DISK_BUDGET bytes,
+    never the snapshot of keep, nor snapshots that another process is writing
+    """
+    snapshots = {} # Snapshot name to (last used, bytes)
+    for entry in os.scandir(SNAPSHOT_DIR):
+        if entry.name.endswith('.arrow'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue # Removed by another process
+            name = entry.name.rsplit('-', 1)[0]
+            mtime, size = snapshots.get(name, (0, 0))
+            snapshots[name] = (max(mtime, stat.st_mtime), size + stat.st_size)
+    footprint = sum(size for _, size in snapshots.values())
+    for (_, size), name in sorted((value, name) for name, value in snapshots.items()): # Least recently used first
+        if footprint <= SNAPSHOT_DISK_BUDGET:
+            break
+        if name != snapshot_name(keep) and try_remove(name):
+            print(f"Removed snapshot {name} from {SNAPSHOT_DIR} ({size:,} bytes)")
+            footprint -= size
+
+def try_remove(name, version=None):
+    """
+    Removes the snapshot called name with its data, unless another process holds its lock, as it is then
+    being refreshed. With version it is only removed if that is still its current version.
+    Returns whether it was removed.
+    """
+    with open(os.path.join(SNAPSHOT_DIR, f"{name}.lock"), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            if version is not None:
+                try:
+                    with open(os.path.join(SNAPSHOT_DIR, f"{name}.json")) as f:
+                        if json.load(f)['version'] != version:
+                            return False
+                except FileNotFoundError:
+                    pass # Only the data is left
+            remove_snapshot_files(name)
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def remove_snapshot(key, version=None):
+    """Removes the snapshot of key if no process is refreshing it, see try_remove"""
+    if os.path.isdir(SNAPSHOT_DIR):
+        return try_remove(snapshot_name(key), version)
+    return False
+
+@contextmanager
+def locked(key):
+    """Holds an exclusive lock on the snapshot of key, shared by all processes on this machine"""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(os.path.join(SNAPSHOT_DIR, f"{snapshot_name(key)}.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
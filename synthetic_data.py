@@ -0,0 +1,339 @@
+"""
+Generates a SQLite database with synthetic donation data, standing in for the production database when
+running the dashboard or benchmarking locally. Start the app against it with DB_BACKEND=sqlite and
+SQLITE_PATH=<path>, and pass create_engine(<path>) to the functions in assets/dbutils.py.
+
+The database has the tables and views the dashboard and assets/dbutils.py read: Donations, Donors,
+v_Donors_anon, Tax_unit, v_Tax_unit_anon, Combining_table, Distribution, Organizations and
+Scorecard_Organization_donations. It is generated in chunks of donors, so it scales from ten thousand to
+ten million donations with bounded memory:
+
+    python synthetic_data.py --donations 1000000 --output synthetic.db
+
+The data has the patterns the preprocessing depends on:
+    * Donors with agreements donate monthly with Payment_ID 3, 7 or 8 (PayPal, AvtaleGiro, Vipps recurring)
+    * Other recurring donors donate every 20 to 45 days with other payment methods
+    * Most donors donate once or a few times with long gaps
+    * Some donor accounts belong to the same person, sharing the full name and/or the ssn of a tax unit
+    * Donors with several KIDs, distributions over several organizations, business tax units, tax units
+      with an empty ssn and donors with several tax units, some with the same ssn
+"""
+import argparse
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import sqlalchemy as db
+
+AGREEMENT_PAYMENT_IDS = [3, 7, 8]
+OTHER_PAYMENT_IDS = [2, 4, 5, 6]
+
+# Share of donors of each kind, and the number of donations they make
+AGREEMENT_SHARE = 0.15
+RECURRING_SHARE = 0.10
+MEAN_AGREEMENT_DONATIONS = 18
+MEAN_RECURRING_DONATIONS = 8
+MEAN_ONE_OFF_DONATIONS = 1.6
+
+# Organizations donated to, from organizations.csv, with their relative popularity. 11 is Drift av Gi Effektivt.
+ORG_IDS = np.array([12, 1, 4, 14, 7, 15, 10, 11])
+ORG_WEIGHTS = np.array([30, 20, 12, 10, 8, 8, 7, 5], dtype=float)
+# Percentage shares of the organizations of distributions over one, two and three organizations, two variants each
+SHARES = np.array([
+    [[0, 0, 0], [0, 0, 0]],
+    [[100, 0, 0], [100, 0, 0]],
+    [[50, 50, 0], [80, 20, 0]],
+    [[40, 30, 30], [34, 33, 33]],
+], dtype=float)
+
+FEMALE_NAMES = ['Anne', 'Inger', 'Kari', 'Marit', 'Ingrid', 'Liv', 'Eva', 'Berit', 'Astrid', 'Bjørg', 'Hilde', 'Anna', 'Solveig', 'Marianne', 'Randi', 'Ida', 'Nina', 'Maria', 'Elisabeth', 'Kristin', 'Silje', 'Ingeborg', 'Camilla', 'Sara', 'Nora', 'Emma']
+MALE_NAMES = ['Jan', 'Per', 'Bjørn', 'Ole', 'Lars', 'Kjell', 'Knut', 'Arne', 'Svein', 'Thomas', 'Hans', 'Geir', 'Tor', 'Morten', 'Terje', 'Odd', 'Erik', 'Martin', 'Andreas', 'John', 'Anders', 'Rune', 'Trond', 'Jonas', 'Magnus', 'Henrik']
+LAST_NAMES = ['Hansen', 'Johansen', 'Olsen', 'Larsen', 'Andersen', 'Pedersen', 'Nilsen', 'Kristiansen', 'Jensen', 'Karlsen', 'Johnsen', 'Pettersen', 'Eriksen', 'Berg', 'Haugen', 'Hagen', 'Johannessen', 'Andreassen', 'Jacobsen', 'Dahl']
+
+SCHEMA = """
+CREATE TABLE Organizations (ID INTEGER PRIMARY KEY, full_name TEXT, abbriv TEXT);
+CREATE TABLE Donors (ID INTEGER PRIMARY KEY, full_name TEXT, email TEXT, password_hash TEXT, date_registered TIMESTAMP, newsletter INTEGER, is_person INTEGER, is_anon INTEGER, Meta_owner_ID INTEGER, name_ID INTEGER);
+CREATE TABLE Tax_unit (ID INTEGER PRIMARY KEY, Donor_ID INTEGER, ssn TEXT, full_name TEXT, registered TIMESTAMP, archived TIMESTAMP, is_business INTEGER, birthdate DATE, gender TEXT);
+CREATE TABLE Distribution (ID INTEGER PRIMARY KEY, OrgId INTEGER, percentage_share REAL);
+CREATE TABLE Combining_table (ID INTEGER PRIMARY KEY, KID TEXT, Distribution_ID INTEGER, Tax_unit_ID INTEGER, Donor_ID INTEGER);
+CREATE TABLE Donations_unordered (Donor_ID INTEGER, Payment_ID INTEGER, Sum_confirmed REAL, Timestamp_confirmed TIMESTAMP, transaction_cost REAL, KID_fordeling TEXT, Meta_owner_ID INTEGER);
+CREATE TABLE Donations (ID INTEGER PRIMARY KEY, Donor_ID INTEGER, Payment_ID INTEGER, Sum_confirmed REAL, Timestamp_confirmed TIMESTAMP, transaction_cost REAL, KID_fordeling TEXT, Meta_owner_ID INTEGER);
+CREATE TABLE Scorecard_Organization_donations (Timestamp TIMESTAMP, Org TEXT, Amount REAL);
+CREATE VIEW v_Donors_anon AS
+    SELECT ID, date_registered, name_ID, password_hash IS NOT NULL AS has_password, is_person, is_anon, Meta_owner_ID, newsletter FROM Donors;
+CREATE VIEW v_Tax_unit_anon AS
+    SELECT ID, Donor_ID, registered, archived, is_business, birthdate, gender FROM Tax_unit;
+"""
+
+# Run once all rows are inserted. Donations get IDs in order of confirmation like in production, and
+# accounts whose full name has at least two words get the same name_ID as the other accounts with that name.
+FINALIZE = """
+INSERT INTO Donations (Donor_ID, Payment_ID, Sum_confirmed, Timestamp_confirmed, transaction_cost, KID_fordeling, Meta_owner_ID)
+    SELECT Donor_ID, Payment_ID, Sum_confirmed, Timestamp_confirmed, transaction_cost, KID_fordeling, Meta_owner_ID
+    FROM Donations_unordered ORDER BY Timestamp_confirmed;
+DROP TABLE Donations_unordered;
+CREATE TEMP TABLE Names AS
+    SELECT DISTINCT lower(trim(full_name)) AS name FROM Donors WHERE instr(trim(full_name), ' ') > 0;
+CREATE INDEX temp.Names_name ON Names (name);
+UPDATE Donors SET name_ID = coalesce(
+    (SELECT Names.rowid FROM Names WHERE Names.name = lower(trim(Donors.full_name))),
+    (SELECT count(*) FROM Names) + Donors.ID);
+CREATE INDEX Donations_Donor_ID ON Donations (Donor_ID);
+CREATE INDEX Donations_Timestamp_confirmed ON Donations (Timestamp_confirmed);
+CREATE INDEX Donations_KID_fordeling ON Donations (KID_fordeling);
+CREATE INDEX Tax_unit_Donor_ID ON Tax_unit (Donor_ID);
+CREATE INDEX Combining_table_KID ON Combining_table (KID);
+INSERT INTO Scorecard_Organization_donations
+    SELECT datetime(date(ds.Timestamp_confirmed)), o.abbriv, sum(ds.Sum_confirmed * dist.percentage_share / 100)
+    FROM Donations ds
+    INNER JOIN Combining_table c ON c.KID = ds.KID_fordeling
+    INNER JOIN Distribution dist ON dist.ID = c.Distribution_ID
+    INNER JOIN Organizations o ON o.ID = dist.OrgId
+    GROUP BY date(ds.Timestamp_confirmed), o.abbriv;
+"""
+
+def create_engine(path):
+    # Columns declared as DATE or TIMESTAMP are returned as datetimes, like from MySQL
+    return db.create_engine(f"sqlite:///{path}", connect_args={'detect_types': sqlite3.PARSE_DECLTYPES})
+
+def choose(rng, values, n):
+    return np.asarray(values, dtype=object)[rng.integers(0, len(values), n)]
+
+def digits(numbers, width):
+    return np.char.mod(f'%0{width}d', numbers).astype(object)
+
+def random_times(rng, start, end, n):
+    return start + pd.to_timedelta(rng.random(n) * (end - start).total_seconds(), unit='s').floor('s')
+
+def generate_donors(rng, first_id, n, start, end, duplicate_rate):
+    """
+    Returns the donors, and the birthdate, gender and ssn of the person behind each account.
+    Duplicate accounts copy the full name and/or the person of an earlier account in the same chunk.
+    """
+    ids = first_id + np.arange(n)
+    female = rng.random(n) < 0.5
+    first_names = np.where(female, choose(rng, FEMALE_NAMES, n), choose(rng, MALE_NAMES, n))
+    # Numbered surnames, so that different persons rarely have the same name
+    last_names = choose(rng, LAST_NAMES, n) + rng.integers(0, 10**6, n).astype(str).astype(object)
+    full_names = first_names + ' ' + last_names
+    name_kind = rng.random(n)
+    full_names[name_kind < 0.03] = first_names[name_kind < 0.03] # Single word names are never merged
+    full_names[name_kind < 0.01] = ''
+
+    birthdates = pd.Timestamp('1940-01-01') + pd.to_timedelta(rng.integers(0, 65 * 365, n), unit='D')
+    individual = rng.integers(0, 500, n) * 2 + ~female # Odd for men, like in Norwegian ssns
+    ssns = (np.asarray(birthdates.strftime('%d%m%y'), dtype=object) + digits(individual, 3) + digits(rng.integers(0, 100, n), 2))
+    genders = np.where(female, 'F', 'M').astype(object)
+
+    duplicate = (rng.random(n) < duplicate_rate) & (np.arange(n) > 0)
+    source = (rng.random(n) * np.arange(n)).astype(int)
+    kind = rng.random(n)
+    same_name = duplicate & (kind < 0.7)
+    same_person = duplicate & (kind >= 0.4)
+    full_names[same_name] = full_names[source[same_name]]
+    ssns[same_person] = ssns[source[same_person]]
+    genders[same_person] = genders[source[same_person]]
+    birthdates = birthdates.where(~same_person, birthdates[source])
+
+    registered = random_times(rng, start, end, n)
+    donors = pd.DataFrame({
+        'ID': ids,
+        'full_name': full_names,
+        'email': np.char.add(np.char.add('donor', ids.astype(str)), '@example.com'),
+        'password_hash': np.where(rng.random(n) < 0.3, 'x', None),
+        'date_registered': registered,
+        'newsletter': (rng.random(n) < 0.4).astype(int),
+        'is_person': (rng.random(n) < 0.97).astype(int),
+        'is_anon': (ids == 1).astype(int), # Donor 1 collects the anonymous donations
+        'Meta_owner_ID': 3,
+        'name_ID': None,
+    })
+    return donors, pd.Series(birthdates), ssns, genders
+
+def generate_tax_units(rng, first_id, donors, birthdates, ssns, genders):
+    """
+    Returns the tax units of donors, and the ID of the first personal and business tax unit of each donor (-1 if none)
+    """
+    n = len(donors)
+    is_person = donors['is_person'].to_numpy() == 1
+    personal = is_person & (rng.random(n) < 0.6)
+    second = personal & (rng.random(n) < 0.03) # Another ssn, e.g. of a spouse
+    # The same ssn registered twice. Only for ssns of a single donor, which the two-pass merge of earlier
+    # versions of assets/dbutils.py could not handle, so that benchmarks stay comparable across versions.
+    shared = pd.Series(ssns).duplicated(keep=False).to_numpy()
+    repeated = personal & ~shared & (rng.random(n) < 0.02)
+    business = ~is_person | (rng.random(n) < 0.04)
+    ssns = ssns.copy()
+    ssns[rng.random(n) < 0.01] = ''
+
+    parts = []
+    for kind, mask in [('personal', personal), ('second', second), ('repeated', repeated), ('business', business)]:
+        idx = np.flatnonzero(mask)
+        part = pd.DataFrame({
+            'Donor_ID': donors['ID'].to_numpy()[idx],
+            'ssn': ssns[idx],
+            'full_name': donors['full_name'].to_numpy()[idx],
+            'registered': donors['date_registered'].to_numpy()[idx],
+            'archived': None,
+            'is_business': 0,
+            'birthdate': birthdates.dt.date.to_numpy()[idx],
+            'gender': genders[idx],
+            'kind': kind,
+            'row': idx,
+        })
+        if kind == 'second':
+            part['ssn'] = digits(rng.integers(0, 10**11, len(idx), dtype=np.int64), 11)
+            part['birthdate'] = None
+            part['gender'] = None
+        if kind == 'business':
+            part['ssn'] = digits(rng.integers(10**8, 10**9, len(idx)), 9)
+            part['full_name'] = part['full_name'] + ' AS'
+            part[['birthdate', 'gender']] = None
+            part['is_business'] = 1
+        parts.append(part)
+    tax_units = pd.concat(parts, ignore_index=True).sort_values(by='row', kind='stable', ignore_index=True)
+    tax_units.insert(0, 'ID', first_id + np.arange(len(tax_units)))
+
+    personal_tu = np.full(n, -1)
+    business_tu = np.full(n, -1)
+    first_personal = tax_units[tax_units['kind'] == 'personal']
+    first_business = tax_units[tax_units['kind'] == 'business']
+    personal_tu[first_personal['row'].to_numpy()] = first_personal['ID'].to_numpy()
+    business_tu[first_business['row'].to_numpy()] = first_business['ID'].to_numpy()
+    return tax_units.drop(columns=['kind', 'row']), personal_tu, business_tu
+
+def generate_distributions(rng, first_id, donors, personal_tu, business_tu):
+    """
+    Returns the distributions and combining table rows of the KIDs of donors, and the number of KIDs of each donor.
+    KIDs are the donor ID followed by the number of the KID.
+    """
+    n = len(donors)
+    n_kids = 1 + (rng.random(n) < 0.15)
+    kid_row = np.repeat(np.arange(n), n_kids)
+    kid_number = np.arange(len(kid_row)) - np.repeat(np.cumsum(n_kids) - n_kids, n_kids)
+    kids = digits(donors['ID'].to_numpy()[kid_row], 8) + kid_number.astype(str).astype(object)
+
+    # The first KID is registered on the personal tax unit, the second on the business one, when the donor has them
+    preferred = np.where(kid_number == 0, personal_tu[kid_row], business_tu[kid_row])
+    fallback = np.where(kid_number == 0, business_tu[kid_row], personal_tu[kid_row])
+    tax_unit_ids = np.where(preferred >= 0, preferred, fallback).astype(object)
+    tax_unit_ids[tax_unit_ids == -1] = None
+
+    n_orgs = rng.choice([1, 2, 3], size=len(kids), p=[0.6, 0.25, 0.15])
+    # Weighted sampling without replacement: the organizations with the smallest keys are chosen
+    keys = -np.log(rng.random((len(kids), len(ORG_IDS)))) / ORG_WEIGHTS
+    orgs_by_key = ORG_IDS[np.argsort(keys, axis=1)]
+    share_rows = np.repeat(np.arange(len(kids)), n_orgs)
+    share_number = np.arange(len(share_rows)) - np.repeat(np.cumsum(n_orgs) - n_orgs, n_orgs)
+    template = rng.integers(0, 2, len(kids))
+    shares = SHARES[n_orgs[share_rows], template[share_rows], share_number]
+
+    ids = first_id + np.arange(len(share_rows))
+    distribution = pd.DataFrame({'ID': ids, 'OrgId': orgs_by_key[share_rows, share_number], 'percentage_share': shares})
+    combining = pd.DataFrame({
+        'ID': ids,
+        'KID': kids[share_rows],
+        'Distribution_ID': ids,
+        'Tax_unit_ID': tax_unit_ids[share_rows],
+        'Donor_ID': donors['ID'].to_numpy()[kid_row[share_rows]],
+    })
+    return distribution, combining, n_kids
+
+def generate_donations(rng, donors, n_kids, start, end):
+    """Returns the donations of donors, see the module docstring for the kinds of donors"""
+    n = len(donors)
+    kind = rng.random(n)
+    agreement = kind < AGREEMENT_SHARE
+    recurring = (kind >= AGREEMENT_SHARE) & (kind < AGREEMENT_SHARE + RECURRING_SHARE)
+    one_off = ~agreement & ~recurring
+    counts = np.where(agreement, rng.geometric(1 / MEAN_AGREEMENT_DONATIONS, n),
+             np.where(recurring, 1 + rng.geometric(1 / (MEAN_RECURRING_DONATIONS - 1), n), rng.geometric(1 / MEAN_ONE_OFF_DONATIONS, n)))
+
+    row = np.repeat(np.arange(n), counts)
+    number = np.arange(len(row)) - np.repeat(np.cumsum(counts) - counts, counts)
+    gap_days = np.where(agreement[row], 30 + rng.uniform(-2, 2, len(row)),
+               np.where(recurring[row], rng.uniform(20, 45, len(row)), rng.uniform(30, 400, len(row))))
+    gap_days[number == 0] = 0
+    days = np.cumsum(gap_days)
+    days -= np.repeat(days[np.cumsum(counts) - counts], counts) # Days since the first donation of the donor
+    first = donors['date_registered'].to_numpy() + pd.to_timedelta(rng.uniform(0, 30, n), unit='D').to_numpy()
+    timestamps = pd.DatetimeIndex(first[row] + pd.to_timedelta(days, unit='D').to_numpy()).floor('s')
+
+    amounts = np.where(one_off[row], np.round(rng.lognormal(6.5, 1.2, len(row)), -1).clip(10),
+                       np.asarray([100, 200, 300, 500, 1000], dtype=float)[rng.integers(0, 5, n)][row])
+    payment_ids = np.where(agreement, choose(rng, AGREEMENT_PAYMENT_IDS, n), choose(rng, OTHER_PAYMENT_IDS, n))[row]
+    payment_ids = np.where(one_off[row], choose(rng, OTHER_PAYMENT_IDS, len(row)), payment_ids).astype(int)
+    kid_number = (rng.random(len(row)) * n_kids[row]).astype(int)
+
+    donations = pd.DataFrame({
+        'Donor_ID': donors['ID'].to_numpy()[row],
+        'Payment_ID': payment_ids,
+        'Sum_confirmed': amounts,
+        'Timestamp_confirmed': timestamps,
+        'transaction_cost': np.where(payment_ids == 3, np.round(amounts * 0.034 + 2.5, 2), 0.0),
+        'KID_fordeling': digits(donors['ID'].to_numpy()[row], 8) + kid_number.astype(str).astype(object),
+        'Meta_owner_ID': 3,
+    })
+    return donations[timestamps < end] # Donors are still donating
+
+def write_gendered_names(path):
+    # The list of names add_gender in assets/dbutils.py guesses genders from
+    names = pd.DataFrame({'Guttenavn': pd.Series(MALE_NAMES), 'Jentenavn': pd.Series(FEMALE_NAMES)})
+    names.to_csv(path, index=False)
+
+def generate(path, n_donations, seed=0, start='2018-01-01', end=None, duplicate_rate=0.05, chunk_size=200000):
+    """
+    Writes a synthetic database with about n_donations donations to path, replacing any existing file.
+    Donations are confirmed between start and end (default now). The dashboard shows the years from 2018.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end) if end is not None else pd.Timestamp.now().floor('s')
+    if os.path.exists(path):
+        os.remove(path)
+
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    organizations = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'organizations.csv'))
+    organizations[['ID', 'full_name', 'abbriv']].to_sql('Organizations', con, if_exists='append', index=False)
+
+    n_written = 0
+    donor_id, tax_unit_id, distribution_id = 1, 1, 1
+    while n_written < n_donations:
+        # About four donations per donor
+        n_donors = min(chunk_size, (n_donations - n_written) // 4 + 100)
+        donors, birthdates, ssns, genders = generate_donors(rng, donor_id, n_donors, start, end, duplicate_rate)
+        tax_units, personal_tu, business_tu = generate_tax_units(rng, tax_unit_id, donors, birthdates, ssns, genders)
+        distribution, combining, n_kids = generate_distributions(rng, distribution_id, donors, personal_tu, business_tu)
+        donations = generate_donations(rng, donors, n_kids, start, end).iloc[:n_donations - n_written]
+
+        donors.to_sql('Donors', con, if_exists='append', index=False)
+        tax_units.to_sql('Tax_unit', con, if_exists='append', index=False)
+        distribution.to_sql('Distribution', con, if_exists='append', index=False)
+        combining.to_sql('Combining_table', con, if_exists='append', index=False)
+        donations.to_sql('Donations_unordered', con, if_exists='append', index=False)
+        con.commit()
+
+        n_written += len(donations)
+        donor_id += len(donors)
+        tax_unit_id += len(tax_units)
+        distribution_id += len(distribution)
+        print(f"Generated {n_written:,} of {n_donations:,} donations")
+
+    print("Ordering donations and building indexes")
+    con.executescript(FINALIZE)
+    con.commit()
+    con.close()
+    write_gendered_names(os.path.join(os.path.dirname(os.path.abspath(path)), 'GenderedNames.csv'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a SQLite database with synthetic donation data.')
+    parser.add_argument('--donations', type=int, default=100000, help='Number of donations (default 100000)')
+    parser.add_argument('--output', default='synthetic.db', help='Path of the database file (default synthetic.db)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator (default 0)')
+    parser.add_argument('--start', default='2018-01-01', help='Date of the first donations (default 2018-01-01)')
+    parser.add_argument('--end', default=None, help='Date of the last donations (default now)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='Share of donor accounts that duplicate another account (default 0.05)')
+    parser.add_argument('--chunk-size', type=int, default=200000, help='Donors generated at a time (default 200000)')
+    args = parser.parse_args()
+    generate(args.output, args.donations, seed=args.seed, start=args.start, end=args.end, duplicate_rate=args.duplicate_rate, chunk_size=args.chunk_size)
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event, Thread
+import time
+import database_import as dbi
+import donations_analytics
+import plotting.histogram_plot as histogram_plot
+import plotting.organizations_plot as organizations_plot
+import plotting.yearly_growth_plot as yearly_growth_plot
+
+# Tables and aggregates queried by the pages
+QUERIES = [
+    partial(dbi.get_df, table_name='Donations', columns=dbi.DONATIONS_COLUMNS, dtypes=dbi.DONATIONS_DTYPES),
+    partial(dbi.get_df, table_name='Scorecard_Organization_donations', columns=dbi.SCORECARD_COLUMNS, dtypes=dbi.SCORECARD_DTYPES),
+    partial(dbi.get_aggregate, 'Donations', 'Sum_confirmed', 'D'),
+    partial(dbi.get_aggregate, 'Donations', 'Sum_confirmed', 'M'),
+    partial(dbi.get_aggregate, 'Donations', 'Sum_confirmed', 'M', recurring_only=True),
+]
+
+# Derived data of the pages, built once the queries are done
+AGGREGATES = [
+    donations_analytics.get_analytics,
+    histogram_plot.get_data,
+    yearly_growth_plot.get_data,
+    organizations_plot.get_data,
+]
+
+RETRY_DELAY = 10 # Seconds to wait before retrying a failed warm-up
+
+ready = Event() # Set when all tables and aggregates are loaded
+
+def warm_up():
+    # Runs all queries concurrently, then builds all derived data concurrently
+    with ThreadPoolExecutor(max_workers=max(len(QUERIES), len(AGGREGATES))) as executor:
+        list(executor.map(lambda query: query(), QUERIES))
+        list(executor.map(lambda build: build(), AGGREGATES))
+
+def run():
+    while True:
+        start = time.time()
+        try:
+            warm_up()
+        except Exception as e:
+            print(f"Warm-up failed, retrying in {RETRY_DELAY} seconds: {e}")
+            time.sleep(RETRY_DELAY)
+            continue
+        print(f"Warm-up finished in {time.time() - start:.1f} seconds")
+        ready.set()
+        return
+
+def start():
+    """Starts the warm-up on a background thread, so that the server can answer health checks meanwhile"""
+    Thread(target=run, name='warm-up', daemon=True).start()